@@ -0,0 +1,54 @@
+'''import time of the times2bright modules, to check that the LCA
+libraries (brightway2, bw2data, bw2analyzer, scipy) are not imported
+until they are used. Each module is imported in a new interpreter.
+
+usage: python benchmarks/bench_import.py [repeats]
+
+It exits with an error if a module imports one of the LCA libraries or
+takes longer than LIMIT seconds.
+'''
+import os
+import subprocess
+import sys
+
+MODULES = ['times2bright', 'times2bright.preprotimes', 'times2bright.analyse',
+           'times2bright.integrate', 'times2bright.search', 'times2bright.bulk',
+           'times2bright.overlay', 'times2bright.calculate', 'times2bright.cache',
+           'times2bright.harmonise', 'times2bright.pipeline']
+HEAVY = ['brightway2', 'bw2data', 'bw2calc', 'bw2analyzer', 'scipy']
+LIMIT = 2.0
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CODE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(elapsed, ','.join(heavy))
+'''
+
+
+def bench(module, repeats=5):
+    '''best import time of a module (seconds) and the heavy modules it
+    imported'''
+    times = []
+    for _ in range(repeats):
+        out = subprocess.run([sys.executable, '-c', CODE.format(module=module, heavy=HEAVY)],
+                             cwd=ROOT, capture_output=True, text=True, check=True)
+        elapsed, heavy = out.stdout.split()[0], out.stdout.split()[1:]
+        times.append(float(elapsed))
+    return(min(times), heavy[0].split(',') if heavy else [])
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    failed = False
+    for module in MODULES:
+        elapsed, heavy = bench(module, repeats)
+        problem = heavy or elapsed > LIMIT
+        failed = failed or bool(problem)
+        print('{:<26} {:8.3f} s {}'.format(module, elapsed,
+                                         'imports ' + ', '.join(heavy) if heavy else ''))
+    sys.exit(1 if failed else 0)
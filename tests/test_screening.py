@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+from times2bright.preprotimes import screen_batch, screen_processes
+
+
+def _n_loop(absdiff, cutoff):
+    '''number of processes selected by the original loop of
+    screen_processes'''
+    top_p = (absdiff/absdiff.sum()).sort_values(ascending=False).values.tolist()
+    counter = 0
+    summation = 0
+    for p in top_p:
+        if summation > cutoff:
+            break
+        summation = summation + p
+        counter = counter + 1
+    return(counter)
+
+
+def _cases():
+    yield [0.]*5, [79., 11., 10., 20., 80.], 0.95
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        alternative = rng.integers(0, 100, 6).astype(float)
+        shares = np.sort(alternative)[::-1]/alternative.sum()
+        # cutoff equal to a partial sum, where rounding matters
+        cutoff = float(sum(shares[:rng.integers(1, 6)].tolist()))
+        yield [0.]*6, list(alternative), min(cutoff, 0.99)
+
+
+@pytest.mark.parametrize('baseline, alternative, cutoff', list(_cases()))
+def test_selection_matches_loop(baseline, alternative, cutoff):
+    processes = ['p' + str(i) for i in range(len(baseline))]
+    s_baseline = pd.Series(baseline, index=processes)
+    s_alternative = pd.Series(alternative, index=processes)
+    expected = _n_loop((s_alternative - s_baseline).abs(), cutoff)
+
+    assert len(screen_processes(s_baseline, s_alternative, cutoff=cutoff)) == expected
+
+    co2eq = pd.DataFrame([baseline, alternative], index=['base', 'alt'], columns=processes)
+    assert len(screen_batch(co2eq, 'base', cutoff=cutoff)) == expected
@@ -0,0 +1,19 @@
+'''times2bright: life cycle assessment with results of TIMES models.
+
+The modules are imported when they are first used, e.g.
+times2bright.preprotimes, so importing the package is cheap.
+'''
+import importlib
+
+__all__ = ['analyse', 'bulk', 'cache', 'calculate', 'harmonise', 'integrate',
+           'overlay', 'pipeline', 'preprotimes', 'search']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return(importlib.import_module('.' + name, __name__))
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
+
+def __dir__():
+    return(sorted(list(globals()) + __all__))
@@ -0,0 +1,39 @@
+'''command line entry point, runs the pipeline of run_pipeline:
+
+python -m times2bright config.json [-o output] [-w workers] [--force]
+
+The paths in the configuration are relative to the configuration file.
+'''
+import argparse
+import json
+import os
+from .pipeline import run_pipeline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m times2bright',
+        description='runs the stages from the TIMES results to the LCA report, '
+                    'only the stages affected by changes are run again')
+    parser.add_argument('config', help='json file with the configuration (see run_pipeline)')
+    parser.add_argument('-o', '--output', default=None,
+                        help="directory of the results, by default 'output' of the "
+                             "configuration or t2b_output next to it")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='number of processes, by default all the cores')
+    parser.add_argument('--force', action='store_true', help='run all the stages again')
+    args = parser.parse_args(argv)
+
+    with open(args.config) as f:
+        config = json.load(f)
+    base = os.path.dirname(os.path.abspath(args.config))
+    config['scenarios'] = {s: os.path.join(base, p) for s, p in config['scenarios'].items()}
+    if 'harmonise' in config:
+        config['harmonise']['mapping'] = os.path.join(base, config['harmonise']['mapping'])
+    output = args.output or os.path.join(base, config.get('output', 't2b_output'))
+
+    run_pipeline(config, output, workers=args.workers, force=args.force)
+
+
+if __name__ == '__main__':
+    main()
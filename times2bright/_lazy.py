@@ -0,0 +1,37 @@
+import importlib
+
+
+class LazyModule:
+    '''stands for a module, or an attribute of a module, that is only
+    imported the first time it is used. Importing brightway2, bw2data,
+    bw2analyzer or scipy takes seconds, which is paid by every process
+    even if it only preprocesses TIMES files.'''
+
+    def __init__(self, module, attribute=None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            if self._attribute is not None:
+                target = getattr(target, self._attribute)
+            self._target = target
+        return(self._target)
+
+    def __getattr__(self, name):
+        return(getattr(self._load(), name))
+
+    def __call__(self, *args, **kwargs):
+        return(self._load()(*args, **kwargs))
+
+    def __repr__(self):
+        name = self._module if self._attribute is None else self._module + '.' + self._attribute
+        return('<lazy ' + name + ('>' if self._target is None else ', loaded>'))
+
+
+def lazy_import(module, attribute=None):
+    '''returns a LazyModule, e.g. bw = lazy_import('brightway2') or
+    splu = lazy_import('scipy.sparse.linalg', 'splu')'''
+    return(LazyModule(module, attribute))
@@ -1,9 +1,13 @@
-
-import brightway2 as bw
 import numpy as np
+import os
 import pandas as pd
 from collections import defaultdict
-import bw2analyzer as bwa
+from concurrent.futures import ProcessPoolExecutor
+from ._lazy import lazy_import
+
+bw = lazy_import('brightway2')
+factorized = lazy_import('scipy.sparse.linalg', 'factorized')
+bwa = lazy_import('bw2analyzer')
 
 
 def mlca_todf(mlca):
@@ -82,6 +86,51 @@ def direct_impact(lca):
     return(direct_impact)
 
 
+def direct_impacts(activities, methods):
+    '''calculates the direct impact (see direct_impact) of many
+    activities and methods at once, per unit of reference product. No
+    LCI is solved: it is the product of the characterization factors and
+    the columns of the biosphere matrix of the activities, divided by
+    their production amount.
+
+    parameters:
+    ----------
+    activities: list
+        brightway2 activities or their keys
+    methods: list
+        LCIA methods
+
+    returns: pandas dataframe
+        direct impacts with the activity keys as index and one column per
+        method
+    '''
+    keys = [a.key if hasattr(a, 'key') else tuple(a) for a in activities]
+    lca = bw.LCA({k: 1 for k in keys}, methods[0])
+    lca.load_lci_data()
+
+    cols = [lca.activity_dict[k] for k in keys]
+    rows = [lca.product_dict[k] for k in keys]
+    production = lca.technosphere_matrix[rows, cols].A1
+
+    C = _characterization_vectors(lca, methods)
+    impacts = (lca.biosphere_matrix[:, cols].T @ C.T) / production[:, None]
+    return(pd.DataFrame(impacts,
+                        index=pd.MultiIndex.from_tuples(keys, names=('database', 'code')),
+                        columns=methods))
+
+
+def _characterization_vectors(lca, methods):
+    '''characterization factors of several methods, one row per method
+    and one column per biosphere flow of the lca object (the
+    characterization matrices are diagonal). The lca object is left with
+    the last method loaded.'''
+    vectors = []
+    for method in methods:
+        lca.switch_method(method)
+        vectors.append(lca.characterization_matrix.diagonal())
+    return(np.vstack(vectors))
+
+
 def find_isic(act):
 
     '''finds the isic code of a ecoinvent activity
@@ -102,8 +151,253 @@ def find_isic(act):
             if c[0] == 'ISIC rev.4 ecoinvent':
                 colon = c[1].find(':')
                 return((c[1][:colon]), c[1][colon+1:])
-    except:
+    except (KeyError, TypeError, IndexError):
         return(None)
 
-# not sure if needed
-# ca = bwa.ContributionAnalysis()
\ No newline at end of file
+
+def top_contributions(lcas, n=10, method=None):
+    '''finds the processes and biosphere flows that contribute the
+    most to the score of one or many LCAs. It works on the sparse
+    characterized inventory and only sorts the n largest contributions
+    (in absolute value), so it is fast with large databases.
+
+    parameters:
+    ----------
+    lcas: brightway2 lca object, list of them or list of functional units
+        the lca objects should be calculated (lci and lcia). With
+        functional units ({activity or key: amount}) a single LCA is
+        built and factorized for all of them.
+    n: int
+        number of processes and of flows per LCA
+    method: tuple
+        LCIA method, needed with functional units
+
+    returns: pandas dataframe
+        one row per contribution, with the position of the LCA in lcas,
+        kind ('process' or 'flow'), rank, key, name, location, categories,
+        unit, score, share of the total score, isic and isic description
+    '''
+    if not isinstance(lcas, (list, tuple)):
+        lcas = [lcas]
+
+    metadata = {}
+    rows = []
+    for i, lca in enumerate(_calculated(lcas, method)):
+        rev_activity, _, rev_bio = lca.reverse_dict()
+        ci = lca.characterized_inventory
+        for kind, values, rev in (('process', ci.sum(axis=0).A1, rev_activity),
+                                  ('flow', ci.sum(axis=1).A1, rev_bio)):
+            for rank, j in enumerate(_top(values, n)):
+                key = rev[j]
+                if key not in metadata:
+                    metadata[key] = _contributor(key)
+                rows.append(dict(metadata[key], lca=i, kind=kind, rank=rank+1, key=key,
+                                 score=values[j],
+                                 share=values[j]/lca.score if lca.score != 0 else np.nan))
+
+    return(pd.DataFrame(rows, columns=['lca', 'kind', 'rank', 'key', 'name',
+                                       'location', 'categories', 'unit', 'score',
+                                       'share', 'isic', 'isic description']))
+
+
+def _calculated(lcas, method):
+    '''lca objects of top_contributions, the functional units are
+    calculated reusing one factorization'''
+    if not any(isinstance(l, dict) for l in lcas):
+        yield from lcas
+        return
+    func_units = [{k.key if hasattr(k, 'key') else tuple(k): amount
+                   for k, amount in fu.items()} for fu in lcas]
+    lca = bw.LCA({k: 1 for fu in func_units for k in fu}, method)
+    lca.lci(factorize=True)
+    lca.lcia()
+    for fu in func_units:
+        lca.redo_lcia(fu)
+        yield lca
+
+
+def _top(values, n):
+    '''positions of the n largest values (absolute), sorted, without
+    zeros'''
+    n = min(n, len(values))
+    if n == 0:
+        return([])
+    top = np.argpartition(-np.abs(values), n-1)[:n]
+    top = top[np.argsort(-np.abs(values[top]))]
+    return(top[values[top] != 0])
+
+
+def _contributor(key):
+    '''data of an activity or biosphere flow for top_contributions'''
+    act = bw.get_activity(key)
+    isic = find_isic(act) or (None, None)
+    return({'name': act.get('name'),
+            'location': act.get('location'),
+            'categories': tuple(act.get('categories') or ()) or None,
+            'unit': act.get('unit'),
+            'isic': isic[0],
+            'isic description': isic[1]})
+
+
+def paired_monte_carlo(pairs, method, iterations=1000, workers=None, seed=None,
+                       quantiles=(0.05, 0.5, 0.95), reservoir=2000):
+    '''Monte Carlo comparison of activities and their modified copies
+    (e.g. the clones created by harmonise_scenario). In each iteration
+    the baseline and the modified activity are calculated with the same
+    draw: the same supply chain and, for the exchanges of the copy that
+    have uncertainty, the value drawn for the same exchange of the
+    baseline multiplied by the ratio of their amounts. Exchanges without
+    uncertainty in the copy (e.g. aggregated by compound_tflow) keep
+    their amount. The iterations are split among several processes and
+    only running statistics are kept, not the samples.
+
+    parameters:
+    ----------
+    pairs: list of tuples
+        (baseline activity, modified activity), activities or keys
+    method: tuple
+        LCIA method
+    iterations: int
+        number of iterations in total, at least 1
+    workers: int
+        number of processes, by default all the cores but no more than
+        the iterations
+    seed: int
+        seed of the random numbers, for reproducible results
+    quantiles: tuple
+        quantiles of the difference to estimate
+    reservoir: int
+        number of iterations kept (randomly selected) to estimate the
+        quantiles
+
+    returns: pandas dataframe
+        one row per pair with the mean and standard deviation of the
+        baseline, modified and difference (modified - baseline) scores,
+        the quantiles of the difference and the probability of the
+        modified score being lower than the baseline
+    '''
+    pairs = [tuple(a.key if hasattr(a, 'key') else tuple(a) for a in p) for p in pairs]
+    if iterations < 1:
+        raise ValueError('at least one iteration is needed')
+    workers = min(workers or os.cpu_count(), iterations)
+    seeds = np.random.SeedSequence(seed).generate_state(workers)
+    chunks = [iterations//workers + (i < iterations % workers) for i in range(workers)]
+
+    stats = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for s in pool.map(_paired_chunk,
+                          [bw.projects.current]*workers,
+                          [pairs]*workers, [method]*workers, chunks,
+                          [int(x) for x in seeds], [reservoir]*workers):
+            stats = s if stats is None else _merge_stats(stats, s, reservoir)
+            print(stats['n'], 'of', iterations, 'iterations')
+
+    std = np.sqrt(stats['M2']/max(stats['n']-1, 1))
+    df = pd.DataFrame({'baseline': [p[0] for p in pairs],
+                       'modified': [p[1] for p in pairs]})
+    for i, label in enumerate(('baseline', 'modified', 'difference')):
+        df[label + ' mean'] = stats['mean'][:, i]
+        df[label + ' std'] = std[:, i]
+    for q in quantiles:
+        df['difference q' + str(q)] = np.quantile(stats['sample'][:, :, 2], q, axis=0)
+    df['p(modified < baseline)'] = stats['lower']/stats['n']
+    df['iterations'] = stats['n']
+    return(df)
+
+
+def _paired_chunk(project, pairs, method, iterations, seed, reservoir):
+    '''runs the iterations of one process of paired_monte_carlo and
+    returns the running statistics'''
+    # the process may start in the default project (spawn, forkserver) and
+    # should not reuse the database connection of the parent (fork)
+    bw.projects.set_current(project)
+    mc = bw.MonteCarloLCA({k: 1 for p in pairs for k in p}, method, seed=seed)
+    mc.load_data()
+    tech = _correlated(mc.tech_params, mc.activity_dict, pairs, ('row', 'type'))
+    bio = _correlated(mc.bio_params, mc.activity_dict, pairs, ('row',))
+
+    demands = np.zeros((len(mc.product_dict), 2*len(pairs)))
+    for i, p in enumerate(pairs):
+        demands[mc.product_dict[p[0]], 2*i] = 1
+        demands[mc.product_dict[p[1]], 2*i+1] = 1
+
+    rng = np.random.default_rng(seed)
+    stats = {'n': 0, 'mean': np.zeros((len(pairs), 3)), 'M2': np.zeros((len(pairs), 3)),
+             'lower': np.zeros(len(pairs)), 'keys': np.zeros(0),
+             'sample': np.zeros((0, len(pairs), 3))}
+    for _ in range(iterations):
+        mc.rebuild_technosphere_matrix(_draw(mc.tech_rng.next(), *tech))
+        mc.rebuild_biosphere_matrix(_draw(mc.bio_rng.next(), *bio))
+        mc.rebuild_characterization_matrix(mc.cf_rng.next())
+
+        solve = factorized(mc.technosphere_matrix.tocsc())
+        cb = mc.biosphere_matrix.T @ mc.characterization_matrix.diagonal()
+        scores = np.array([cb @ solve(demands[:, j]) for j in range(demands.shape[1])])
+        scores = scores.reshape(len(pairs), 2)
+        values = np.column_stack([scores, scores[:, 1] - scores[:, 0]])
+
+        _update_stats(stats, values, rng, reservoir)
+    return(stats)
+
+
+def _correlated(params, activity_dict, pairs, fields):
+    '''positions of the uncertain parameters of the modified activities,
+    the positions of the same parameters of the baseline and the ratio of
+    their amounts'''
+    targets, sources, ratios = [], [], []
+    for base, modified in pairs:
+        in_base = np.flatnonzero(params['col'] == activity_dict[base])
+        positions = {tuple(params[f][i] for f in fields): i for i in in_base}
+        for i in np.flatnonzero((params['col'] == activity_dict[modified]) &
+                                (params['uncertainty_type'] > 1)):
+            j = positions.get(tuple(params[f][i] for f in fields))
+            if j is not None and params['amount'][j] != 0:
+                targets.append(i)
+                sources.append(j)
+                ratios.append(params['amount'][i]/params['amount'][j])
+    return(np.array(targets, dtype=int), np.array(sources, dtype=int), np.array(ratios))
+
+
+def _draw(sample, targets, sources, ratios):
+    sample = sample.copy()
+    sample[targets] = sample[sources]*ratios
+    return(sample)
+
+
+def _update_stats(stats, values, rng, reservoir):
+    '''adds an iteration to the running mean and sum of squares
+    (Welford) and to the reservoir, the iterations with the lowest random
+    keys are kept so that reservoirs can be merged'''
+    stats['n'] += 1
+    delta = values - stats['mean']
+    stats['mean'] += delta/stats['n']
+    stats['M2'] += delta*(values - stats['mean'])
+    stats['lower'] += values[:, 2] < 0
+
+    stats['keys'] = np.append(stats['keys'], rng.random())
+    stats['sample'] = np.concatenate([stats['sample'], values[None]])
+    if len(stats['keys']) > 2*reservoir:
+        _prune(stats, reservoir)
+
+
+def _prune(stats, reservoir):
+    if len(stats['keys']) > reservoir:
+        keep = np.argpartition(stats['keys'], reservoir-1)[:reservoir]
+        stats['keys'], stats['sample'] = stats['keys'][keep], stats['sample'][keep]
+
+
+def _merge_stats(a, b, reservoir):
+    '''combines the statistics of two processes'''
+    n = a['n'] + b['n']
+    if n == 0:
+        return(a)
+    delta = b['mean'] - a['mean']
+    merged = {'n': n,
+              'mean': a['mean'] + delta*b['n']/n,
+              'M2': a['M2'] + b['M2'] + delta**2*a['n']*b['n']/n,
+              'lower': a['lower'] + b['lower'],
+              'keys': np.concatenate([a['keys'], b['keys']]),
+              'sample': np.concatenate([a['sample'], b['sample']])}
+    _prune(merged, reservoir)
+    return(merged)
+
@@ -0,0 +1,368 @@
+import copy
+import pandas as pd
+from ._lazy import lazy_import
+from .integrate import invalidate_exchanges
+
+bw = lazy_import('brightway2')
+ActivityDataset = lazy_import('bw2data.backends.peewee', 'ActivityDataset')
+ExchangeDataset = lazy_import('bw2data.backends.peewee', 'ExchangeDataset')
+sqlite3_lci_db = lazy_import('bw2data.backends.peewee', 'sqlite3_lci_db')
+dict_as_activitydataset = lazy_import('bw2data.backends.peewee.utils', 'dict_as_activitydataset')
+dict_as_exchangedataset = lazy_import('bw2data.backends.peewee.utils', 'dict_as_exchangedataset')
+ParameterizedExchange = lazy_import('bw2data.parameters', 'ParameterizedExchange')
+
+
+def write_changes(saves=(), deletes=(), activities=(), process=True):
+    '''writes exchanges and activities to the database in a single
+    sqlite transaction and processes each modified database once.
+    Brightway saves each exchange in its own transaction and flags the
+    database as modified (rewriting the metadata file) every time.
+
+    parameters:
+    ----------
+    saves: list of brightway2 exchanges
+        exchanges to save, new or existing
+    deletes: list of brightway2 exchanges
+        exchanges to delete
+    activities: list of brightway2 activities
+        activities to save (e.g. with the harmonisation dict updated)
+    process: bool
+        if true the modified databases are processed at the end,
+        otherwise they are flagged as dirty and processed by brightway
+        before the next calculation.
+
+    returns: set
+        names of the databases modified
+    '''
+    modified = set()
+
+    with sqlite3_lci_db.atomic():
+        for exc in saves:
+            for key, value in dict_as_exchangedataset(exc._data).items():
+                setattr(exc._document, key, value)
+            exc._document.save()
+            modified.add(exc['output'][0])
+
+        for exc in deletes:
+            ParameterizedExchange.delete().where(
+                ParameterizedExchange.exchange == exc._document.id).execute()
+            exc._document.delete_instance()
+            modified.add(exc['output'][0])
+
+        for act in activities:
+            for key, value in dict_as_activitydataset(act._data).items():
+                setattr(act._document, key, value)
+            act._document.save()
+            modified.add(act['database'])
+
+    _processed(modified, process)
+    return(modified)
+
+
+def _processed(modified, process):
+    '''flags the databases as modified and processes them (or flags them
+    as dirty)'''
+    for db in modified:
+        bw.databases.set_modified(db)
+        if process is True:
+            bw.Database(db).process()
+            bw.databases[db].pop('dirty', None)
+            bw.databases.flush()
+        else:
+            bw.databases.set_dirty(db)
+
+
+def _stamp_harmonisation(ds, d):
+    '''updates the harmonisation dict of a dataset (dict as returned by
+    read_datasets), as update_harmonisation does for activities but
+    without registering it in a modification session'''
+    if ds.get('harmonisation') is None:
+        ds['harmonisation'] = {}
+    ds['harmonisation'].update(d)
+
+
+def read_exchanges(ids):
+    '''reads the data of exchanges as stored in the database.
+
+    parameters:
+    ----------
+    ids: list of ids of the exchanges (exc._document.id)
+
+    returns: dict
+        {id: exchange data}
+    '''
+    ids = list(ids)
+    exchanges = {}
+    for chunk in _chunks(ids):
+        query = (ExchangeDataset.select(ExchangeDataset.id, ExchangeDataset.data)
+                 .where(ExchangeDataset.id.in_(chunk)))
+        exchanges.update(query.tuples())
+    return(exchanges)
+
+
+def read_datasets(keys, strict=True):
+    '''reads activities and their exchanges as dicts, in the format
+    used by Database.write, with a few queries per database instead
+    of one per activity.
+
+    parameters:
+    ----------
+    keys: list of activity keys
+    strict: bool
+        if true a KeyError is raised if any activity is not found,
+        otherwise the missing activities are left out
+
+    returns: dict
+        {key: dataset with the list of 'exchanges'}
+    '''
+    datasets = {}
+    for db, codes in _by_database(keys).items():
+        for chunk in _chunks(codes):
+            query = (ActivityDataset.select(ActivityDataset.code, ActivityDataset.data)
+                     .where((ActivityDataset.database == db) &
+                            (ActivityDataset.code.in_(chunk))))
+            for code, data in query.tuples():
+                data['database'], data['code'] = db, code
+                data['exchanges'] = []
+                datasets[(db, code)] = data
+
+            query = (ExchangeDataset.select(ExchangeDataset.output_code,
+                                            ExchangeDataset.data)
+                     .where((ExchangeDataset.output_database == db) &
+                            (ExchangeDataset.output_code.in_(chunk))))
+            for code, data in query.tuples():
+                datasets[(db, code)]['exchanges'].append(data)
+
+    missing = set(keys).difference(datasets)
+    if missing and strict is True:
+        raise KeyError('activities not found: ' + str(sorted(missing)[:5]))
+    return(datasets)
+
+
+def write_datasets(datasets, process=True):
+    '''writes activities (dicts as returned by read_datasets) to their
+    databases in a single sqlite transaction. Unlike Database.write the
+    rest of the database is kept, activities with the same key are
+    replaced. Databases not registered are created.
+
+    parameters:
+    ----------
+    datasets: dict
+        {key: dataset with the list of 'exchanges'}
+    process: bool
+        if true the databases are processed at the end
+
+    returns: set
+        names of the databases modified
+    '''
+    by_db = _by_database(datasets)
+    for db in by_db:
+        if db not in bw.databases:
+            bw.Database(db).register()
+
+    with sqlite3_lci_db.atomic():
+        for db, codes in by_db.items():
+            for chunk in _chunks(codes):
+                ActivityDataset.delete().where(
+                    (ActivityDataset.database == db) &
+                    (ActivityDataset.code.in_(chunk))).execute()
+                ExchangeDataset.delete().where(
+                    (ExchangeDataset.output_database == db) &
+                    (ExchangeDataset.output_code.in_(chunk))).execute()
+
+        activities, exchanges = [], []
+        for key, ds in datasets.items():
+            for exc in ds.get('exchanges', []):
+                exc = dict(exc, output=key)
+                exchanges.append(dict_as_exchangedataset(exc))
+            ds = {k: v for k, v in ds.items() if k != 'exchanges'}
+            ds['database'], ds['code'] = key
+            activities.append(dict_as_activitydataset(ds))
+
+        # sqlite limits the number of variables per query
+        for i in range(0, len(activities), 125):
+            ActivityDataset.insert_many(activities[i:i+125]).execute()
+        for i in range(0, len(exchanges), 125):
+            ExchangeDataset.insert_many(exchanges[i:i+125]).execute()
+
+    # the exchanges kept in memory were deleted with the activities
+    for key in datasets:
+        invalidate_exchanges(key)
+    bw.mapping.add(datasets.keys())
+    bw.geomapping.add({ds['location'] for ds in datasets.values()
+                       if ds.get('location')})
+    _processed(set(by_db), process)
+    return(set(by_db))
+
+
+def clone_activities(activities, database, modify=None, harmonisation=None,
+                     only_modified=False, process=True):
+    '''copies activities to a (scenario) database with a single write,
+    instead of act.copy() for each one. The exchanges between the copied
+    activities are relinked to the copies.
+
+    parameters:
+    ----------
+    activities: list
+        activities (or keys) to copy
+    database: string
+        name of the database of the copies, created if it does not exist.
+        The copies keep the code of the original activity.
+    modify: function
+        called with each dataset (dict as returned by read_datasets) and
+        the key of the original, it changes the dataset in place
+    harmonisation: dict or function
+        added to the harmonisation dict of the copies (e.g. with the
+        scenario and times_pcode), a function is called with the key of
+        the original and returns the dict
+    only_modified: bool
+        if true only the activities changed by modify, and the ones that
+        consume them (directly or not) among the activities given, are
+        copied. The rest are used from the original database.
+    process: bool
+        if true the database is processed after writing
+
+    returns: dict
+        {original key: key to use in the scenario}, the key of the copy or
+        the original key for activities not copied
+    '''
+    keys = [a.key if hasattr(a, 'key') else tuple(a) for a in activities]
+    original = read_datasets(keys)
+    datasets = copy.deepcopy(original)
+    if modify is not None:
+        for key, ds in datasets.items():
+            modify(ds, key)
+
+    if only_modified is True:
+        copied = {k for k in keys if datasets[k] != original[k]}
+        # consumers of copied activities are copied too, to relink them
+        inputs = {k: {tuple(e['input']) for e in ds['exchanges']
+                      if e['type'] != 'production'} for k, ds in datasets.items()}
+        growing = True
+        while growing:
+            new = {k for k in keys if k not in copied and inputs[k] & copied}
+            copied |= new
+            growing = len(new) > 0
+    else:
+        copied = set(keys)
+
+    relinked = {k: ((database, k[1]) if k in copied else k) for k in keys}
+    clones = {}
+    for key in copied:
+        ds = datasets[key]
+        ds['database'], ds['code'] = relinked[key]
+        for e in ds['exchanges']:
+            e.pop('output', None)
+            if tuple(e['input']) in copied:
+                e['input'] = relinked[tuple(e['input'])]
+        if harmonisation is not None:
+            _stamp_harmonisation(ds, harmonisation(key) if callable(harmonisation)
+                                     else harmonisation)
+        clones[relinked[key]] = ds
+
+    print(len(clones), 'of', len(keys), 'activities copied to', database)
+    if len(clones) > 0:
+        write_datasets(clones, process=process)
+    return(relinked)
+
+
+def consolidate_duplicates(database, types=('technosphere',), dry_run=False,
+                           process=True):
+    '''aggregates, in all the activities of a database, the exchanges
+    with the same name and unit into a single exchange, as compound_tflow
+    does for one activity and flow. The provider of the new exchange is
+    the one with the highest amount and its amount is the sum of amounts
+    (the uncertainty is lost). The exchange table is read once and all
+    the changes are written in a single transaction. The harmonisation
+    dict of the modified activities is updated with 'tflow_aggregated'.
+
+    parameters:
+    ----------
+    database: string
+        name of the brightway2 database
+    types: tuple
+        types of exchanges to consolidate
+    dry_run: bool
+        if true nothing is written, only the report is returned
+    process: bool
+        if true the database is processed after writing
+
+    returns: pandas dataframe
+        one row per group of exchanges aggregated, with the activity key,
+        name and unit of the flow, number of exchanges, total amount,
+        provider kept and number of providers
+    '''
+    query = (ExchangeDataset.select(ExchangeDataset.id,
+                                    ExchangeDataset.output_code,
+                                    ExchangeDataset.data)
+             .where((ExchangeDataset.output_database == database) &
+                    (ExchangeDataset.type.in_(list(types)))))
+    groups = {}
+    for id_, code, data in query.tuples():
+        groups.setdefault((code, data.get('name'), data.get('unit'), data['type']),
+                          []).append((id_, data))
+
+    report, deleted, created = [], [], []
+    for (code, name, unit, kind), exchanges in groups.items():
+        if len(exchanges) < 2:
+            continue
+        dominant = max(exchanges, key=lambda e: e[1]['amount'])[1]
+        amount = sum(e[1]['amount'] for e in exchanges)
+        created.append({'flow': dominant.get('flow'),
+                        'unit': unit,
+                        'type': kind,
+                        'name': name,
+                        'input': tuple(dominant['input']),
+                        'output': (database, code),
+                        'comment': 'aggregation of fuels, uncertainty lost',
+                        'amount': amount})
+        deleted.extend(e[0] for e in exchanges)
+        report.append({'activity': (database, code),
+                       'name': name,
+                       'unit': unit,
+                       'exchanges': len(exchanges),
+                       'amount': amount,
+                       'provider': tuple(dominant['input']),
+                       'providers': len({tuple(e[1]['input']) for e in exchanges})})
+
+    report = pd.DataFrame(report, columns=['activity', 'name', 'unit', 'exchanges',
+                                           'amount', 'provider', 'providers'])
+    print(len(report), 'groups of exchanges in',
+          report['activity'].nunique(), 'activities')
+    if dry_run is True or len(report) == 0:
+        return(report)
+
+    codes = list({k[1] for k in report['activity']})
+    with sqlite3_lci_db.atomic():
+        for chunk in _chunks(deleted):
+            ParameterizedExchange.delete().where(
+                ParameterizedExchange.exchange.in_(chunk)).execute()
+            ExchangeDataset.delete().where(ExchangeDataset.id.in_(chunk)).execute()
+        rows = [dict_as_exchangedataset(e) for e in created]
+        for i in range(0, len(rows), 125):
+            ExchangeDataset.insert_many(rows[i:i+125]).execute()
+
+        for chunk in _chunks(codes):
+            query = (ActivityDataset.select(ActivityDataset.id, ActivityDataset.data)
+                     .where((ActivityDataset.database == database) &
+                            (ActivityDataset.code.in_(chunk))))
+            for id_, data in query.tuples():
+                data.setdefault('harmonisation', {})['tflow_aggregated'] = True
+                ActivityDataset.update(data=data).where(ActivityDataset.id == id_).execute()
+
+    invalidate_exchanges()
+    _processed({database}, process)
+    return(report)
+
+
+def _by_database(keys):
+    '''{database: [codes]} of a list of keys'''
+    by_db = {}
+    for db, code in keys:
+        by_db.setdefault(db, []).append(code)
+    return(by_db)
+
+
+def _chunks(codes, size=900):
+    for i in range(0, len(codes), size):
+        yield(codes[i:i+size])
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from ._lazy import lazy_import
+
+bw = lazy_import('brightway2')
+
+
+# entries kept in memory and maximum size of the store on disk
+MEMORY_ENTRIES = 1000
+DISK_BYTES = 100*1024**2
+
+# results recently used, by hashed key
+_memory = OrderedDict()
+
+
+def cached_score(demand, method):
+    '''returns the LCA score of a demand and method, calculated only the
+    first time. The results are kept in memory and in a store in the
+    project directory, so they survive restarts. They are recalculated
+    when any database of the supply chain (or the method) changes, e.g.
+    after modifying an activity with the functions of integrate.
+
+    parameters:
+    ----------
+    demand: dict
+        functional unit, {activity or key: amount}
+    method: tuple
+        LCIA method
+
+    returns: float
+    '''
+    demand = {k.key if hasattr(k, 'key') else tuple(k): amount
+              for k, amount in demand.items()}
+
+    def score():
+        lca = bw.LCA(demand, method)
+        lca.lci()
+        lca.lcia()
+        return(lca.score)
+
+    return(cached('score', (sorted(demand.items()), method), score,
+                  databases={k[0] for k in demand}, methods=[method]))
+
+
+def cached(kind, key, compute, databases=(), methods=()):
+    '''returns compute() the first time it is called with a key and the
+    stored value afterwards, while the fingerprint of the databases (and
+    their dependencies) and methods does not change.
+
+    parameters:
+    ----------
+    kind: string
+        type of result, e.g. 'score'
+    key: object
+        identifies the result, its repr should be stable
+    compute: function
+        called without arguments to calculate the result, which should
+        be picklable
+    databases: list
+        databases used by the calculation
+    methods: list
+        LCIA methods used by the calculation
+
+    returns: result of compute
+    '''
+    digest = hashlib.sha256(repr((bw.projects.current, kind, key,
+                                  fingerprint(databases, methods))).encode()).hexdigest()
+
+    if digest in _memory:
+        _memory.move_to_end(digest)
+        return(_memory[digest])
+
+    with _store() as db:
+        row = db.execute('SELECT value FROM results WHERE key = ?', (digest,)).fetchone()
+        if row is not None:
+            db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), digest))
+    if row is not None:
+        value = pickle.loads(row[0])
+    else:
+        value = compute()
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with _store() as db:
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                       (digest, blob, len(blob), time.time()))
+            _evict(db)
+
+    _memory[digest] = value
+    while len(_memory) > MEMORY_ENTRIES:
+        _memory.popitem(last=False)
+    return(value)
+
+
+def fingerprint(databases=(), methods=()):
+    '''state of databases (including the ones they depend on) and LCIA
+    methods: when they were modified and processed. Dirty databases are
+    processed first, as brightway does before a calculation.
+
+    returns: tuple
+    '''
+    bw.databases.clean()
+    names = set()
+    for db in databases:
+        names.update(bw.Database(db).find_graph_dependents())
+
+    state = [(db, bw.databases[db].get('modified'), bw.databases[db].get('processed'))
+             for db in sorted(names)]
+    for method in methods:
+        path = bw.Method(method).filepath_processed()
+        try:
+            stat = os.stat(path)
+            state.append((tuple(method), stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            state.append((tuple(method), None, None))
+    return(tuple(state))
+
+
+def clear_cache(disk=True):
+    '''removes the results kept in memory and, if disk is true, the
+    results stored in the project directory'''
+    _memory.clear()
+    if disk is True:
+        with _store() as db:
+            db.execute('DELETE FROM results')
+
+
+@contextmanager
+def _store():
+    '''connection to the store of the current project, the changes are
+    committed at the end'''
+    path = os.path.join(bw.projects.request_directory('times2bright'), 'results.sqlite')
+    db = sqlite3.connect(path)
+    try:
+        db.execute('CREATE TABLE IF NOT EXISTS results '
+                   '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)')
+        yield db
+        db.commit()
+    finally:
+        db.close()
+
+
+def _evict(db):
+    '''removes the results used least recently until the store is
+    smaller than DISK_BYTES'''
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+    if total <= DISK_BYTES:
+        return
+    removed = []
+    for key, size in db.execute('SELECT key, size FROM results ORDER BY accessed'):
+        if total <= DISK_BYTES:
+            break
+        removed.append((key,))
+        total -= size
+    db.executemany('DELETE FROM results WHERE key = ?', removed)
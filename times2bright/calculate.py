@@ -0,0 +1,185 @@
+import numpy as np
+import os
+import pandas as pd
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from ._lazy import lazy_import
+from .analyse import _characterization_vectors
+
+bw = lazy_import('brightway2')
+ActivityDataset = lazy_import('bw2data.backends.peewee', 'ActivityDataset')
+splu = lazy_import('scipy.sparse.linalg', 'splu')
+
+
+# results of multi_lca, with the attributes of MultiLCA used by mlca_todf
+MultiLCAResults = namedtuple('MultiLCAResults', ['results', 'methods', 'func_units'])
+
+
+def multi_lca(func_units, methods, workers=None, batch_size=100):
+    '''calculates the scores of many functional units and methods, as
+    MultiLCA does, but the technosphere matrix is factorized only once
+    per process and the demands are solved in batches (several right
+    hand sides per solve). All the methods are characterized at once.
+
+    parameters:
+    ----------
+    func_units: list of dicts
+        functional units, {activity or key: amount}
+    methods: list
+        LCIA methods
+    workers: int
+        number of processes, by default all the cores but no more than
+        the number of batches. With 1 (or a single batch) the calculation
+        is done in the current process.
+    batch_size: int
+        functional units solved together
+
+    returns: namedtuple
+        with results (array of functional units x methods), methods and
+        func_units (with keys), it can be passed to mlca_todf
+    '''
+    func_units = [{_as_key(k): amount for k, amount in fu.items()}
+                  for fu in func_units]
+    lca = bw.LCA({k: 1 for fu in func_units for k in fu}, methods[0])
+    lca.load_lci_data()
+
+    # characterized biosphere matrix, methods x activities
+    CB = (lca.biosphere_matrix.T @ _characterization_vectors(lca, methods).T).T
+    A = lca.technosphere_matrix.tocsc()
+
+    demands = [([lca.product_dict[k] for k in fu], list(fu.values()))
+               for fu in func_units]
+    batches = [demands[i:i+batch_size] for i in range(0, len(demands), batch_size)]
+
+    results = np.zeros((len(func_units), len(methods)))
+    done = 0
+    # each process factorizes the matrix, no more than one per batch
+    workers = min(workers or os.cpu_count(), len(batches))
+    if workers <= 1:
+        _init_worker(A, CB)
+        scores = map(_solve_batch, batches)
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=_init_worker,
+                                   initargs=(A, CB))
+        scores = pool.map(_solve_batch, batches)
+    try:
+        for batch in scores:
+            results[done:done+len(batch)] = batch
+            done += len(batch)
+            print(done, 'of', len(func_units), 'functional units calculated')
+    finally:
+        if workers > 1:
+            pool.shutdown()
+
+    return(MultiLCAResults(results, list(methods), func_units))
+
+
+def period_lca(activity, database, methods, scenario=None, conversion=None,
+               workers=None, batch_size=100):
+    '''calculates the impacts of the whole system modelled in TIMES for
+    each year and timeslice. The processes are mapped to the harmonised
+    activities of a database (by the times_pcode and year of their
+    harmonisation dict, as created by harmonise_scenario) and one demand
+    is built per column. All the columns are solved with multi_lca.
+
+    parameters:
+    ----------
+    activity: pandas dataframe
+        activity levels with the process (or a multiindex including the
+        'process' level) as index and the (year, ts) header of
+        preprocess_times, e.g. the VAR_Act rows of one scenario
+    database: string
+        database with the harmonised activities
+    methods: list
+        LCIA methods
+    scenario: string
+        if given only the activities harmonised for that scenario are used
+    conversion: dict or pandas series
+        factors to convert the TIMES activity to the amount of the
+        reference product of the activity, by times_pcode (default 1)
+    workers: int
+        passed to multi_lca
+    batch_size: int
+        passed to multi_lca
+
+    returns: pandas dataframe
+        impacts with the methods as index and the columns of activity
+    '''
+    if isinstance(activity.index, pd.MultiIndex):
+        activity = activity.groupby(level='process', observed=True).sum()
+    if conversion is not None:
+        factors = pd.Series(conversion).reindex(activity.index).fillna(1)
+        activity = activity.mul(factors, axis=0)
+
+    activities = harmonised_activities(database, scenario)
+    func_units = []
+    missing = set()
+    for column in activity.columns:
+        year = column[0] if isinstance(column, tuple) else column
+        levels = activity[column]
+        fu = {}
+        for process, amount in levels[levels.notna() & (levels != 0)].items():
+            key = activities.get((process, str(year)), activities.get((process, None)))
+            if key is None:
+                missing.add(process)
+            else:
+                fu[key] = fu.get(key, 0) + amount
+        func_units.append(fu)
+
+    if missing:
+        print('careful,', len(missing), 'processes without harmonised activity:')
+        print(sorted(missing, key=str))
+
+    mlca = multi_lca(func_units, methods, workers=workers, batch_size=batch_size)
+    return(pd.DataFrame(mlca.results.T, index=pd.Index(methods, tupleize_cols=False),
+                        columns=activity.columns))
+
+
+def harmonised_activities(database, scenario=None):
+    '''harmonised activities of a database, read with one query.
+
+    parameters:
+    ----------
+    database: string
+    scenario: string
+        if given only the activities harmonised for that scenario
+
+    returns: dict
+        {(times_pcode, year as string or None): activity key}
+    '''
+    query = (ActivityDataset.select(ActivityDataset.code, ActivityDataset.data)
+             .where(ActivityDataset.database == database))
+    activities = {}
+    for code, data in query.tuples():
+        h = data.get('harmonisation') or {}
+        if 'times_pcode' not in h:
+            continue
+        if scenario is not None and h.get('scenario') != scenario:
+            continue
+        year = h.get('year')
+        activities[(h['times_pcode'], None if year is None else str(year))] = (database, code)
+    return(activities)
+
+
+def _as_key(act):
+    return(act.key if hasattr(act, 'key') else tuple(act))
+
+
+# factorized technosphere matrix and characterized biosphere matrix of
+# the process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(A, CB):
+    _worker['lu'] = splu(A)
+    _worker['CB'] = CB
+
+
+def _solve_batch(demands):
+    '''scores of a batch of demands (rows and amounts), functional
+    units x methods'''
+    D = np.zeros((_worker['CB'].shape[1], len(demands)))
+    for i, (rows, amounts) in enumerate(demands):
+        np.add.at(D[:, i], rows, amounts)
+    return((_worker['CB'] @ _worker['lu'].solve(D)).T)
@@ -0,0 +1,209 @@
+import copy
+import hashlib
+import numpy as np
+import pandas as pd
+from ._lazy import lazy_import
+from .bulk import _stamp_harmonisation, read_datasets, write_datasets
+from .integrate import flow_categories, in_compartments
+
+bw = lazy_import('brightway2')
+
+
+def harmonise_scenario(mapping,
+                       scenario,
+                       database,
+                       scale_factors=None,
+                       fuels=None,
+                       providers=None,
+                       years=None,
+                       compartments=('air',),
+                       dry_run=False,
+                       process=True):
+    '''clones the brightway2 activities mapped to TIMES processes into a
+    scenario database, one clone per process and year, and harmonises
+    them with the TIMES results: the fuel consumption and the emissions
+    are scaled (as scale_fuel_cons does) and the fuel provider is changed
+    if the process switches fuel (as change_origin_tflow does). The
+    harmonisation dict of the clones includes the scenario, times_pcode
+    and year. All the clones are written at once.
+
+    parameters:
+    ----------
+    mapping: pandas dataframe
+        one row per TIMES process with columns 'times_pcode', 'activity'
+        (key of the brightway2 activity), 'fuel' (name of its fuel flow)
+        and optionally 'literal' (bool, used to identify the fuel flow)
+    scenario: string
+        name of the TIMES scenario
+    database: string
+        name of the scenario database, created if it does not exist
+    scale_factors: pandas dataframe
+        factors to scale the fuel consumption, with times_pcode as index
+        and year as header, e.g. generated with efficiency_factors.
+        Missing values are not scaled.
+    fuels: pandas dataframe
+        TIMES commodity used as fuel with times_pcode as index and year
+        as header, e.g. generated with main_fuel
+    providers: dict
+        {TIMES commodity: key of the brightway2 activity providing it}
+    years: list
+        years to clone, by default the years of scale_factors and fuels.
+        If there are none a single clone is done per process.
+    compartments: tuple
+        compartments of the emissions scaled with the fuel, see
+        in_compartments
+    dry_run: bool
+        if true nothing is written, only the report is returned
+    process: bool
+        if true the scenario database is processed after writing
+
+    returns: pandas dataframe
+        one row per clone with the changes applied, or the error found
+    '''
+    if years is None:
+        years = []
+        for df in (scale_factors, fuels):
+            if df is not None:
+                years.extend(y for y in df.columns.tolist() if y not in years)
+        if len(years) == 0:
+            years = [None]
+    if providers is None:
+        providers = {}
+
+    datasets = read_datasets(list({tuple(k) for k in mapping['activity']}), strict=False)
+    provider_acts = {c: bw.get_activity(k) for c, k in providers.items()}
+
+    clones = {}
+    report = []
+    for row in mapping.itertuples(index=False):
+        key = tuple(row.activity)
+        literal = bool(getattr(row, 'literal', False))
+        for year in years:
+            factor = _lookup(scale_factors, row.times_pcode, year)
+            if factor is None:
+                factor = 1
+            provider = provider_acts.get(_lookup(fuels, row.times_pcode, year))
+            code = _clone_code(key, scenario, row.times_pcode, year)
+
+            record = {'times_pcode': row.times_pcode,
+                      'year': year,
+                      'activity': key,
+                      'code': code,
+                      'scale_factor': factor,
+                      'provider': None if provider is None else provider.key}
+            if key not in datasets:
+                record['status'] = 'activity not found'
+                report.append(record)
+                continue
+            try:
+                ds, changes = harmonised_dataset(datasets[key],
+                                                 row.fuel,
+                                                 literal=literal,
+                                                 scale_factor=factor,
+                                                 provider=provider,
+                                                 compartments=compartments)
+            except ValueError as e:
+                record['status'] = str(e)
+                report.append(record)
+                continue
+
+            _stamp_harmonisation(ds, {'scenario': scenario,
+                                      'times_pcode': row.times_pcode,
+                                      'year': year})
+            clones[(database, code)] = _relabel(ds, key, (database, code))
+            record.update(changes)
+            record['status'] = 'ok'
+            report.append(record)
+
+    report = pd.DataFrame(report)
+    print(len(clones), 'activities harmonised,',
+          len(report)-len(clones), 'with errors')
+
+    if dry_run is False and len(clones) > 0:
+        write_datasets(clones, process=process)
+    return(report)
+
+
+def harmonised_dataset(ds, fuel, literal=False, scale_factor=1, provider=None,
+                       compartments=('air',)):
+    '''returns a copy of an activity dataset (as given by read_datasets)
+    with the fuel flow and the emissions scaled, and the fuel provider
+    changed. The same checks as scale_fuel_cons and change_origin_tflow
+    are done.
+
+    parameters:
+    ----------
+    ds: dict
+        activity dataset with the list of 'exchanges'
+    fuel: string
+        identifies the fuel technosphere flow
+    literal: bool
+        if true the fuel should match exactly the name of the flow
+    scale_factor: float
+        factor to scale the fuel and the emissions
+    provider: brightway2 activity
+        new provider of the fuel, None to keep it
+    compartments: tuple
+        compartments of the emissions to scale
+
+    returns: tuple
+        the dataset and a dict with the number of flows changed
+    '''
+    ds = copy.deepcopy(ds)
+    fuel_flows = [e for e in ds['exchanges']
+                  if e['type'] in ('technosphere', 'substitution') and
+                  (e.get('name') == fuel if literal else fuel in e.get('name', ''))]
+
+    if len(set([e['name'] for e in fuel_flows])) != 1:
+        raise ValueError('incorrect fuel identification')
+
+    changes = {'fuel_flows': len(fuel_flows), 'emissions_scaled': 0}
+    if scale_factor != 1:
+        for e in fuel_flows:
+            e['amount'] = e['amount']*scale_factor
+        for e in ds['exchanges']:
+            if (e['type'] == 'biosphere' and
+                    in_compartments(flow_categories(e['input']), compartments)):
+                e['amount'] = e['amount']*scale_factor
+                changes['emissions_scaled'] += 1
+        _stamp_harmonisation(ds, {'eff_scaled': True})
+
+    if provider is not None and any(e['input'] != provider.key for e in fuel_flows):
+        for e in fuel_flows:
+            if e.get('unit') != provider['unit']:
+                raise ValueError('activity and technosphere flows with different units')
+            e['input'] = provider.key
+            e['name'] = provider['reference product']
+        _stamp_harmonisation(ds, {'tflow_origin': True})
+
+    return(ds, changes)
+
+
+def _lookup(df, process, year):
+    '''value of a process and year in a parameter table, None if missing'''
+    if df is None or year is None:
+        return(None)
+    try:
+        value = df.at[process, year]
+    except KeyError:
+        return(None)
+    if isinstance(value, float) and np.isnan(value):
+        return(None)
+    # numpy scalars to python ones, they are stored in the database
+    return(value.item() if hasattr(value, 'item') else value)
+
+
+def _clone_code(key, scenario, times_pcode, year):
+    '''code of a clone, always the same for the same inputs so that
+    running again replaces the clones'''
+    return(hashlib.md5(str((key, scenario, times_pcode, year)).encode()).hexdigest())
+
+
+def _relabel(ds, old_key, new_key):
+    '''sets the key of a dataset, the production exchanges are relinked'''
+    ds['database'], ds['code'] = new_key
+    for e in ds['exchanges']:
+        e.pop('output', None)
+        if e['type'] == 'production' and tuple(e['input']) == old_key:
+            e['input'] = new_key
+    return(ds)
@@ -1,9 +1,223 @@
-import brightway2 as bw
+import copy
 import numpy as np
 import pandas as pd
 import re
+from contextlib import contextmanager
+from ._lazy import lazy_import
+from .search import activity_index
 
-def find_tflow(act,flow_name,literal=False,toprint=True):
+bw = lazy_import('brightway2')
+ActivityDataset = lazy_import('bw2data.backends.peewee', 'ActivityDataset')
+sparse = lazy_import('scipy.sparse')
+
+
+# exchanges of the activities already queried, by project and activity key
+_exchange_index = {}
+
+
+def exchange_index(act):
+    '''returns the technosphere and biosphere exchanges of an activity
+    grouped by name. The exchanges are fetched from the database only the
+    first time, later calls use the ones kept in memory. The exchanges
+    saved or deleted with the functions of this module are kept up to
+    date, use invalidate_exchanges if the activity is modified otherwise.
+
+    parameters:
+    ----------
+    act: brighway2 activity
+
+    returns: dict
+        with the list of all exchanges ('exchanges') and dicts
+        {name: list of exchanges} for 'technosphere' and 'biosphere'
+    '''
+    key = (bw.projects.current, act.key)
+    try:
+        return(_exchange_index[key])
+    except KeyError:
+        pass
+
+    exchanges = [ex for ex in act.exchanges()
+                 if ex['type'] in ('technosphere', 'substitution', 'biosphere')]
+    _exchange_index[key] = _group_exchanges(exchanges)
+    return(_exchange_index[key])
+
+
+def invalidate_exchanges(act=None):
+    '''removes the exchanges of an activity or activity key (or of all
+    activities if act is None) from the exchange index, so they are
+    fetched again'''
+    if act is None:
+        _exchange_index.clear()
+    else:
+        key = act.key if hasattr(act, 'key') else tuple(act)
+        _exchange_index.pop((bw.projects.current, key), None)
+
+
+def _group_exchanges(exchanges):
+    '''builds the exchange index of a list of exchanges'''
+    index = {'exchanges': exchanges, 'technosphere': {}, 'biosphere': {}}
+    for ex in exchanges:
+        kind = 'biosphere' if ex['type'] == 'biosphere' else 'technosphere'
+        index[kind].setdefault(ex['name'], []).append(ex)
+    return(index)
+
+
+def _refresh_exchanges(key, saved=None, deleted=None):
+    '''updates the exchange index of an activity after saving or
+    deleting one of its exchanges. Names may have changed.'''
+    key = (bw.projects.current, tuple(key))
+    index = _exchange_index.get(key)
+    if index is None:
+        return
+    exchanges = [ex for ex in index['exchanges'] if ex is not deleted]
+    if saved is not None and not any(ex is saved for ex in exchanges):
+        exchanges.append(saved)
+    _exchange_index[key] = _group_exchanges(exchanges)
+
+
+def _save(exc):
+    '''saves an exchange keeping the exchange index up to date. If a
+    modification session is open the exchange is only validated and the
+    write is left for the end of the session.'''
+    if _session is None:
+        exc.save()
+    else:
+        if not exc.valid():
+            raise ValueError('exchange can not be saved: ' + str(exc.valid(why=True)[1]))
+        if not any(e is exc for e in _session['saves']):
+            _session['saves'].append(exc)
+    _refresh_exchanges(exc['output'], saved=exc)
+
+
+def _delete(exc):
+    '''deletes an exchange keeping the exchange index up to date. If a
+    modification session is open the deletion is left for the end of the
+    session.'''
+    if _session is None:
+        exc.delete()
+    else:
+        _session['saves'][:] = [e for e in _session['saves'] if e is not exc]
+        # exchanges created in the session are not in the database yet
+        if exc._document.id is not None:
+            _session['deletes'].append(exc)
+    _refresh_exchanges(exc['output'], deleted=exc)
+
+
+# pending changes of the open modification session, if any
+_session = None
+
+
+@contextmanager
+def modification_session(process=True):
+    '''context manager to apply many modifications at once. The
+    functions of this module (scale_fuel_cons, change_origin_tflow,...)
+    called inside the session change the exchanges in memory and
+    validate them, but nothing is written until the session ends. Then
+    all the exchanges, and the activities with their harmonisation dict
+    updated, are written in a single transaction and each database is
+    processed once. If an error is raised inside the session, or while
+    writing the changes, nothing is written and the exchanges and
+    harmonisation dicts in memory are restored.
+
+    parameters:
+    ----------
+    process: bool
+        if true the modified databases are processed at the end of the
+        session, otherwise brightway does it before the next calculation
+
+    returns: dict
+        pending 'saves', 'deletes' and 'activities' of the session
+
+    example:
+    ----------
+    with modification_session():
+        for act, fuel, factor in changes:
+            scale_fuel_cons(act, fuel, factor)
+    '''
+    from .bulk import write_changes
+
+    with _pending_changes() as session:
+        yield session
+
+    try:
+        write_changes(session['saves'],
+                      session['deletes'],
+                      session['activities'],
+                      process=process)
+    except BaseException:
+        _discard_session(session)
+        raise
+
+
+@contextmanager
+def _pending_changes():
+    '''opens a session and returns its pending changes when it ends.
+    If an error is raised inside the session the changes are discarded.'''
+    global _session
+    if _session is not None:
+        raise RuntimeError('a modification session is already open')
+    _session = {'saves': [], 'deletes': [], 'activities': [], 'harmonisation': []}
+
+    try:
+        yield _session
+    except BaseException:
+        session, _session = _session, None
+        _discard_session(session)
+        raise
+    _session = None
+
+
+def _touch_activity(act):
+    '''registers an activity modified inside a session, keeping a copy
+    of its harmonisation dict in case the session is discarded'''
+    if _session is None or any(a is act for a in _session['activities']):
+        return
+    _session['activities'].append(act)
+    try:
+        _session['harmonisation'].append(copy.deepcopy(act['harmonisation']))
+    except:
+        _session['harmonisation'].append(None)
+
+
+def _discard_session(session):
+    '''undoes the in-memory changes of a session: the exchanges of the
+    activities modified are fetched again and the harmonisation dicts
+    restored'''
+    for act, harmonisation in zip(session['activities'], session['harmonisation']):
+        if harmonisation is None:
+            try:
+                del act['harmonisation']
+            except:
+                pass
+        else:
+            act['harmonisation'] = harmonisation
+    # only the activities changed in the session are fetched again
+    for exc in session['saves'] + session['deletes']:
+        invalidate_exchanges(exc['output'])
+    for act in session['activities']:
+        invalidate_exchanges(act)
+
+
+def _query_exchanges(act, kind, flow_name, literal, regex):
+    '''exchanges of the given kind whose name matches flow_name,
+    in the order they are stored'''
+    names = exchange_index(act)[kind]
+    if literal == True:
+        matched = {flow_name} & set(names)
+    elif regex == True:
+        pattern = re.compile(flow_name)
+        matched = {n for n in names if pattern.search(n)}
+    else:
+        matched = {n for n in names if flow_name in n}
+
+    if len(matched) <= 1:
+        return([ex for n in matched for ex in names[n]])
+    return([ex for ex in exchange_index(act)['exchanges']
+            if ex['name'] in matched and
+            (ex['type'] == 'biosphere') == (kind == 'biosphere')])
+
+
+def find_tflow(act,flow_name,literal=False,toprint=True,regex=False):
     '''it returns the reference of the technosphere flows that  
     match the flow_name, it could be more than one if
     the process consumes two types of flows with similar names
@@ -19,6 +233,9 @@ def find_tflow(act,flow_name,literal=False,toprint=True):
         string in their name.
     toprint: bool
         either to print or not the flow name.
+    regex: bool
+        if true (and literal is false) flow_name is used as a regular
+        expression
 
     returns:
     list of technosphere exchanges with that flow name.
@@ -26,10 +243,7 @@ def find_tflow(act,flow_name,literal=False,toprint=True):
 
     assert isinstance(flow_name,str), 'flow_name should be a string'
 
-    if literal == False:
-        tflow_query = [ex for ex in act.technosphere() if (flow_name in ex['name'])]
-    if literal == True:
-        tflow_query = [ex for ex in act.technosphere() if (flow_name == ex['name'])]
+    tflow_query = _query_exchanges(act, 'technosphere', flow_name, literal, regex)
 
     if (len(tflow_query)!=1):
         print('careful',len(tflow_query),'flows with the name:')
@@ -39,7 +253,7 @@ def find_tflow(act,flow_name,literal=False,toprint=True):
     return(tflow_query)
 
 
-def find_eflow(act, flow_name, literal=False, toprint=True):
+def find_eflow(act, flow_name, literal=False, toprint=True, regex=False):
     '''it returns a list of biosphere flows, that
     match a given name.
 
@@ -54,15 +268,15 @@ def find_eflow(act, flow_name, literal=False, toprint=True):
         string in their name.
     toprint: bool
         either to print or not the flow name.
+    regex: bool
+        if true (and literal is false) flow_name is used as a regular
+        expression
     returns:
     list of biosphere exchanges with that flow name.
     '''
     assert isinstance(flow_name, str), 'flow_name should be a string'
 
-    if literal == False:
-        bflow_query = [ex for ex in act.biosphere() if (flow_name in ex['name'])]
-    if literal == True:
-        bflow_query = [ex for ex in act.biosphere() if (flow_name == ex['name'])]
+    bflow_query = _query_exchanges(act, 'biosphere', flow_name, literal, regex)
     
     if toprint == True: print(len(bflow_query),'flows with the name:')
     
@@ -119,6 +333,125 @@ def determine_eff(act, flow, literal=False):
         return(np.nan)
 
 
+def efficiency_table(database, fuel, emissions=(), literal=False, regex=False,
+                     compartments=None, activities=None):
+    '''efficiency (output per unit of fuel) and emission factors
+    (emission per unit of fuel) of all the activities of a database, as
+    determine_eff and determine_ef but read from the technosphere and
+    biosphere matrices instead of querying each activity. The flows are
+    identified by the reference product of their provider (technosphere)
+    or the name of the flow (biosphere).
+
+    parameters:
+    ----------
+    database: string
+        name of the brightway2 database
+    fuel: string
+        identifies the fuel flows
+    emissions: list of strings
+        identify the emissions, one emission factor per element
+    literal: bool
+        if true the names should match exactly
+    regex: bool
+        if true (and literal is false) the names are regular expressions
+    compartments: tuple
+        if given only the emissions to these compartments, see
+        in_compartments
+    activities: list
+        activities (or keys) of the database to include, by default all
+
+    returns: pandas dataframe
+        indexed by the activity key, with columns name, location, unit,
+        production amount, fuel (name), fuel unit, fuel amount, efficiency,
+        fuel flows (number of fuel flows) and the flags no fuel, several
+        fuels (different names, scale_fuel_cons would refuse them) and
+        mixed units, and one column per emission with the emission factor.
+    '''
+    table = activity_index(database)
+    if activities is None:
+        keys = [(database, code) for code in table.index]
+    else:
+        keys = [k.key if hasattr(k, 'key') else tuple(k) for k in activities]
+
+    lca = bw.LCA({k: 1 for k in keys})
+    lca.load_lci_data()
+    _, rev_product, rev_bio = lca.reverse_dict()
+
+    cols = [lca.activity_dict[k] for k in keys]
+    A = lca.technosphere_matrix.tocsr()
+    production = A[[lca.product_dict[k] for k in keys], cols].A1
+
+    products = _flow_labels([rev_product[i] for i in range(A.shape[0])],
+                            ['reference product', 'unit'])
+    is_fuel = _name_matches(products['reference product'].fillna(''), fuel, literal, regex)
+    # inputs are negative in the technosphere matrix, the production of
+    # the fuel itself is left out
+    F = (-A[is_fuel][:, cols]).tocoo()
+    inputs = F.data > 0
+    F = sparse.coo_matrix((F.data[inputs], (F.row[inputs], F.col[inputs])), shape=F.shape)
+    flows = pd.DataFrame({'column': F.col,
+                          'fuel': products['reference product'].to_numpy()[is_fuel][F.row],
+                          'fuel unit': products['unit'].to_numpy()[is_fuel][F.row]})
+    flows = flows.groupby('column').agg(**{
+        'fuel': ('fuel', 'first'),
+        'fuel unit': ('fuel unit', 'first'),
+        'fuel flows': ('fuel', 'size'),
+        'names': ('fuel', 'nunique'),
+        'units': ('fuel unit', 'nunique')}).reindex(range(len(keys)))
+    fuel_amount = np.asarray(F.tocsc().sum(axis=0)).ravel()
+
+    info = table.reindex([k[1] for k in keys])
+    df = pd.DataFrame({'name': info['name'].to_numpy(),
+                       'location': info['location'].to_numpy(),
+                       'unit': info['unit'].to_numpy(),
+                       'production amount': production,
+                       'fuel': flows['fuel'].to_numpy(),
+                       'fuel unit': flows['fuel unit'].to_numpy(),
+                       'fuel amount': fuel_amount},
+                      index=pd.MultiIndex.from_tuples(keys, names=['database', 'code']))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['efficiency'] = np.where(fuel_amount != 0, production/fuel_amount, np.nan)
+    df['fuel flows'] = flows['fuel flows'].fillna(0).astype(int).to_numpy()
+    df['no fuel'] = df['fuel flows'] == 0
+    df['several fuels'] = (flows['names'] > 1).to_numpy()
+    df['mixed units'] = (flows['units'] > 1).to_numpy()
+
+    if len(emissions) > 0:
+        B = lca.biosphere_matrix.tocsr()
+        bio_keys = [rev_bio[i] for i in range(B.shape[0])]
+        names = _flow_labels(bio_keys, ['name'])['name'].fillna('')
+        if compartments is not None:
+            in_comp = np.array([in_compartments(flow_categories(k), compartments)
+                                for k in bio_keys], dtype=bool)
+        for emission in emissions:
+            rows = _name_matches(names, emission, literal, regex)
+            if compartments is not None:
+                rows = rows & in_comp
+            amount = np.asarray(B[rows][:, cols].sum(axis=0)).ravel()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                df[emission] = np.where(fuel_amount != 0, amount/fuel_amount, np.nan)
+    return(df)
+
+
+def _flow_labels(keys, columns):
+    '''columns of the activity index for a list of keys, of several
+    databases'''
+    by_db = {}
+    for db, code in keys:
+        by_db.setdefault(db, []).append(code)
+    tables = pd.concat({db: activity_index(db)[columns] for db in by_db},
+                       names=['database', 'code'])
+    return(tables.reindex(pd.MultiIndex.from_tuples(keys)))
+
+
+def _name_matches(names, flow_name, literal, regex):
+    '''boolean array of the names that match flow_name, as in
+    find_tflow'''
+    if literal == True:
+        return((names == flow_name).to_numpy())
+    return(names.str.contains(flow_name, regex=regex == True).to_numpy())
+
+
 def determine_ef(act, tflow, bflow, literal=False):
     '''provides the emission factor given the fuel flow, and
     a biosphere (emission) flow. Prints the units of the
@@ -237,7 +570,7 @@ def change_origin_tflow(act,flow_name,act_nflow,literal=False):
         
         t.input=act_nflow
         t['name']=act_nflow['reference product']
-        t.save()
+        _save(t)
     
     update_harmonisation(act,{'tflow_origin':True})
             
@@ -247,6 +580,7 @@ def update_harmonisation(act,d):
     '''update the dictionary with harmonisation parameters
     if not existing create one.'''
 
+    _touch_activity(act)
     try:
         act['harmonisation'].update(d)
     except:
@@ -279,7 +613,7 @@ def scale_technosphere_flow(act,flow_name,scale_factor=1,literal=False):
         
     for t in tf:
         t['amount']=t['amount']*scale_factor
-        t.save()
+        _save(t)
 
         #as it is we only store one tflow scaled
         update_harmonisation(act,{'tfow_scaled':True})
@@ -315,14 +649,14 @@ def scale_biosphere_flow(act,flow_name,scale_factor=1,literal=False):
         
     for b in bf:
         b['amount']=b['amount']*scale_factor
-        b.save()
+        _save(b)
         
         update_harmonisation(act,{'ef_scaled':True})
         #act['harmonisation'].update({'ef_scaled':b['name']})
     return(act)
 
 
-def scale_fuel_cons(act,fuel_name,scale_factor=1,literal=False):
+def scale_fuel_cons(act,fuel_name,scale_factor=1,literal=False,compartments=('air',)):
     '''scale a fuel technosphere flow and all biosphere emissions
     to air, which are assumed to be caused by fuel consumption
     
@@ -339,6 +673,9 @@ def scale_fuel_cons(act,fuel_name,scale_factor=1,literal=False):
         if true it will try to match the exact name of the flow_name
         otherwise, it will include all flows that contain the flow_name
         string in their name.
+    compartments: tuple
+        compartments of the emissions to scale, see in_compartments.
+        By default all emissions to air.
     
     returns:
     activity with the exchanges updated.
@@ -350,16 +687,80 @@ def scale_fuel_cons(act,fuel_name,scale_factor=1,literal=False):
     
     for f in tf:
         f['amount']=f['amount']*scale_factor
-        f.save()
-    for exc in act.biosphere():
-        if bw.get_activity(exc['input'])['categories'][0]=='air':
+        _save(f)
+    for exc in list(exchange_index(act)['exchanges']):
+        if exc['type'] != 'biosphere':
+            continue
+        if in_compartments(flow_categories(exc['input']), compartments):
             exc['amount']=exc['amount']*scale_factor
-            exc.save()
+            _save(exc)
     
     update_harmonisation(act,{'eff_scaled':True})
 
     return (act)
 
+# categories of the biosphere flows, by (project, database)
+_biosphere_categories = {}
+
+
+def biosphere_categories(database='biosphere3'):
+    '''returns the categories (compartment and subcompartment) of all
+    the flows of a biosphere database. They are read with a single query
+    and kept in memory until the database changes.
+
+    parameters:
+    ----------
+    database: string
+        name of the biosphere database
+
+    returns: dict
+        {flow key: tuple of categories}
+    '''
+    key = (bw.projects.current, database)
+    modified = bw.databases[database].get('modified')
+
+    stored = _biosphere_categories.get(key)
+    if stored is None or stored[0] != modified:
+        query = (ActivityDataset.select(ActivityDataset.code, ActivityDataset.data)
+                 .where(ActivityDataset.database == database))
+        stored = (modified, {(database, code): tuple(data.get('categories') or ())
+                             for code, data in query.tuples()})
+        _biosphere_categories[key] = stored
+    return(stored[1])
+
+
+def flow_categories(key):
+    '''returns the categories of a biosphere flow given its key, using
+    biosphere_categories'''
+    try:
+        return(biosphere_categories(key[0])[key])
+    except KeyError:
+        return(tuple(bw.get_activity(key)['categories']))
+
+
+def in_compartments(categories, compartments=('air',)):
+    '''checks if the categories of a biosphere flow belong to any of
+    the compartments.
+
+    parameters:
+    ----------
+    categories: tuple
+        categories of the flow, e.g. ('air', 'urban air close to ground')
+    compartments: tuple
+        each element is a compartment (e.g. 'air') or a tuple with a
+        compartment and subcompartment, e.g. ('air', 'lower stratosphere +
+        upper troposphere')
+
+    returns: bool
+    '''
+    for c in compartments:
+        if isinstance(c, str):
+            c = (c,)
+        if tuple(categories[:len(c)]) == tuple(c):
+            return(True)
+    return(False)
+
+
 def isit_modified(bw_activity):
     '''returns true if the activity has entries in the 
     harmonisation dict. This dict is used to register
@@ -424,10 +825,10 @@ def compound_tflow(act,tflow_name,literal=False):
                           comment='aggregation of fuels, uncertainty lost',
                           amount=f_amount)
         
-        newflow.save()
+        _save(newflow)
         
         for f in tf:
-            f.delete()
+            _delete(f)
         
         
     return(act)
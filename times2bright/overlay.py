@@ -0,0 +1,218 @@
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from ._lazy import lazy_import
+from .analyse import _characterization_vectors
+from .bulk import read_exchanges
+from .integrate import _discard_session, _pending_changes, scale_fuel_cons
+
+bw = lazy_import('brightway2')
+sparse = lazy_import('scipy.sparse')
+
+
+@contextmanager
+def virtual_modifications():
+    '''context manager to try modifications of activities without
+    changing the database. The functions of integrate (scale_fuel_cons,
+    change_origin_tflow,...) called inside work as usual, but nothing is
+    written: when the context ends the changes are undone and returned
+    as a patch, the changes of the values of the technosphere and
+    biosphere matrices. The patch is applied to LCA objects with
+    apply_patch or patched_lca. No copy of the activity is needed.
+
+    returns: list
+        the patch, filled when the context ends. One dict per changed
+        matrix value with 'input', 'output', 'type' and 'amount' (change
+        of the exchange amount)
+
+    example:
+    ----------
+    with virtual_modifications() as patch:
+        scale_fuel_cons(car, 'diesel, low-sulfur', 0.5)
+    lca = patched_lca({car: 1}, ipcc2013, patch)
+    '''
+    patch = []
+    with _pending_changes() as session:
+        yield patch
+
+    try:
+        patch.extend(_as_patch(session))
+    finally:
+        _discard_session(session)
+
+
+def _as_patch(session):
+    '''changes of the exchange amounts of a session, the previous values
+    are read from the database'''
+    ids = [e._document.id for e in session['saves'] + session['deletes']
+           if e._document.id is not None]
+    stored = read_exchanges(ids)
+
+    changes = {}
+
+    def add(data, sign):
+        key = (tuple(data['input']), tuple(data['output']), data['type'])
+        changes[key] = changes.get(key, 0) + sign*data['amount']
+
+    for e in session['saves']:
+        if e._document.id is not None:
+            add(stored[e._document.id], -1)
+        add(e._data, 1)
+    for e in session['deletes']:
+        add(stored[e._document.id], -1)
+
+    return([{'input': i, 'output': o, 'type': t, 'amount': amount}
+            for (i, o, t), amount in changes.items() if amount != 0])
+
+
+def patch_matrices(lca, patch):
+    '''converts a patch in changes of the technosphere and biosphere
+    matrices of a LCA object (after load_lci_data or lci).
+
+    returns: tuple
+        sparse matrices with the changes of the technosphere and the
+        biosphere matrix
+    '''
+    tech = ([], [], [])
+    bio = ([], [], [])
+    for p in patch:
+        try:
+            col = lca.activity_dict[p['output']]
+            if p['type'] == 'biosphere':
+                entries, row = bio, lca.biosphere_dict[p['input']]
+            else:
+                entries, row = tech, lca.product_dict[p['input']]
+        except KeyError:
+            raise ValueError('{} or {} not in the LCA matrices, include them in '
+                             'the demand (even with amount 0)'.format(p['input'],
+                                                                     p['output']))
+        # technosphere inputs are negative in the technosphere matrix
+        sign = -1 if p['type'] == 'technosphere' else 1
+        entries[0].append(sign*p['amount'])
+        entries[1].append(row)
+        entries[2].append(col)
+
+    tech = sparse.coo_matrix((tech[0], (tech[1], tech[2])),
+                             shape=lca.technosphere_matrix.shape).tocsr()
+    bio = sparse.coo_matrix((bio[0], (bio[1], bio[2])),
+                            shape=lca.biosphere_matrix.shape).tocsr()
+    return(tech, bio)
+
+
+def apply_patch(lca, patch):
+    '''adds the changes of a patch to the technosphere and biosphere
+    matrices of a LCA object (after load_lci_data or lci). To get the
+    results use lca.lci_calculation() and lca.lcia_calculation(), or
+    redo_lcia.
+
+    parameters:
+    ----------
+    lca: brightway2 lca object
+    patch: list
+        generated with virtual_modifications
+    '''
+    tech, bio = patch_matrices(lca, patch)
+    lca.technosphere_matrix = (lca.technosphere_matrix + tech).tocsr()
+    lca.biosphere_matrix = (lca.biosphere_matrix + bio).tocsr()
+    # factorization of the matrix before the patch
+    if hasattr(lca, 'solver'):
+        del lca.solver
+
+
+def patched_lca(demand, method=None, patch=(), factorize=False):
+    '''calculates a LCA with the matrices changed by a patch, the
+    database is not modified.
+
+    parameters:
+    ----------
+    demand: dict
+        functional unit, as in bw.LCA
+    method: tuple
+        LCIA method, if None only the LCI is calculated
+    patch: list
+        generated with virtual_modifications
+    factorize: bool
+        if true the technosphere matrix is factorized, to reuse it with
+        redo_lci
+
+    returns: brightway2 lca object
+    '''
+    lca = bw.LCA(demand, method)
+    lca.load_lci_data()
+    apply_patch(lca, patch)
+    lca.build_demand_array()
+    if factorize is True:
+        lca.decompose_technosphere()
+    lca.lci_calculation()
+    if method is not None:
+        lca.lcia()
+    return(lca)
+
+
+def sweep_scale_factor(demand, act, flow_name, factors, methods,
+                       modifier=scale_fuel_cons, literal=False, **kwargs):
+    '''scores of a functional unit for many values of the scale factor
+    of an activity flow, without modifying the database. The flows are
+    scaled (virtually) with a modifier of integrate (scale_fuel_cons,
+    scale_technosphere_flow, scale_biosphere_flow) and the technosphere
+    matrix is factorized only once: the change of the flows is a low rank
+    update of the matrix (one column per activity modified) that is
+    solved with the Woodbury formula for each factor.
+
+    parameters:
+    ----------
+    demand: dict
+        functional unit, as in bw.LCA. It should include (directly or in
+        its supply chain) the activity and the flows modified
+    act: brightway2 activity
+        activity to modify
+    flow_name: string
+        identifies the flow, as in find_tflow/find_eflow
+    factors: list
+        scale factors to evaluate
+    methods: list
+        LCIA methods
+    modifier: function
+        function of integrate called as modifier(act, flow_name,
+        scale_factor=..., literal=literal, **kwargs). The changes should
+        be proportional to (scale_factor - 1), as for the scale_ functions.
+    literal: bool
+        if true the flow_name should exactly match the name of the flow
+
+    returns: pandas dataframe
+        scores with the factors as index and one column per method
+    '''
+    # changes of the flows for a scale factor of 2, i.e. per unit of
+    # (scale_factor - 1)
+    with virtual_modifications() as patch:
+        modifier(act, flow_name, scale_factor=2, literal=literal, **kwargs)
+
+    lca = bw.LCA(demand, methods[0])
+    lca.load_lci_data()
+    tech, bio = patch_matrices(lca, patch)
+    lca.build_demand_array()
+    lca.decompose_technosphere()
+
+    cols = np.union1d(tech.tocoo().col, bio.tocoo().col)
+    # tech = U E', E selects the modified columns
+    U = tech[:, cols].toarray()
+    x = lca.solver(lca.demand_array)
+    Y = np.column_stack([lca.solver(u) for u in U.T]) if len(cols) else U
+
+    C = _characterization_vectors(lca, methods)
+    CB = (lca.biosphere_matrix.T @ C.T).T
+    CBd = (bio.T @ C.T).T
+    CBx, CBY = CB @ x, CB @ Y
+    CBdx, CBdY = CBd @ x, CBd @ Y
+    Ex, EY = x[cols], Y[cols, :]
+    I = np.eye(len(cols))
+
+    scores = []
+    for f in factors:
+        t = f - 1
+        # (A + tUE')^-1 d = x - tY (I + tE'Y)^-1 E'x
+        z = np.linalg.solve(I + t*EY, Ex)
+        scores.append(CBx - t*CBY @ z + t*(CBdx - t*CBdY @ z))
+
+    return(pd.DataFrame(scores, index=pd.Index(factors, name='scale_factor'),
+                        columns=methods))
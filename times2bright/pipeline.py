@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import pickle
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from ._lazy import lazy_import
+from .analyse import mlca_todf
+from .calculate import multi_lca
+from .harmonise import harmonise_scenario
+from .preprotimes import (_file_hash, co2eq_cube, efficiency_factors, main_fuel,
+                          preprocess_times, process_efficiency, screen_processes,
+                          tech_and_bio)
+
+bw = lazy_import('brightway2')
+
+# bump when a stage changes its results, to recompute the stored ones
+STAGE_VERSION = 1
+
+
+def run_pipeline(config, output, workers=None, force=False):
+    '''runs the stages from the TIMES excel files to the LCA of the
+    harmonised activities: preprocess_times, tech_and_bio and co2eq_cube
+    (per scenario), screen_processes (each scenario against the
+    baseline), harmonise_scenario (of the processes selected) and
+    multi_lca/mlca_todf. The result of each stage is stored in
+    output/artifacts with a hash of its parameters and of the content
+    of its inputs, so only the stages
+    affected by a change in the configuration or in a TIMES file are run
+    again, and a stage whose result did not change stops the rerun of the
+    ones that use it. The stages of different scenarios that do not use
+    brightway run in parallel.
+
+    parameters:
+    ----------
+    config: dict
+        'scenarios': {scenario: path of the excel file}
+        'baseline': scenario to compare the rest with
+        'gwp': {gas: gwp}, by default GWP_TABLE['GWP100']
+        'patterns': arguments of tech_and_bio (pat_ghg_inclusive,...)
+        'year': year of the screening, by default the sum of all years
+        'cutoff': cutoff of screen_processes (default 0.95)
+        'harmonise' (optional): 'mapping' (csv file with columns
+            times_pcode, database, code, fuel and optionally literal),
+            'database' (name of the scenario databases, {scenario} is
+            replaced), 'providers' ({commodity: [database, code]}) and
+            optionally 'project', 'attribute_in', 'attribute_out',
+            'commodities_in', 'commodities_out', 'reference', 'dry_run'
+        'lca' (optional): 'methods' (list of LCIA methods)
+    output: string
+        directory for the artifacts and reports
+    workers: int
+        number of processes, by default all the cores
+    force: bool
+        if true all the stages are run again
+
+    returns: dict
+        {stage: 'run' or 'stored'}
+    '''
+    stages = build_stages(config)
+    artifacts = os.path.join(output, 'artifacts')
+    os.makedirs(artifacts, exist_ok=True)
+
+    keys, path, digest, status = {}, {}, {}, {}
+    pending = list(stages)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while pending:
+            # stages whose inputs are done, keyed by the content of the inputs
+            ready = [n for n in pending if all(i in digest for i in stages[n]['inputs'])]
+            if not ready:
+                raise RuntimeError('stages with missing inputs: ' + str(pending))
+            for n in ready:
+                keys[n] = _stage_key(n, stages[n], [digest[i] for i in stages[n]['inputs']])
+                path[n] = os.path.join(artifacts, n.replace('/', '-') + '-' + keys[n] + '.pickle')
+                if not force and os.path.exists(path[n]):
+                    status[n] = 'stored'
+            to_run = [n for n in ready if n not in status]
+            futures = {n: pool.submit(_run_stage, stages[n], path, path[n])
+                       for n in to_run if stages[n]['parallel']}
+            for n in to_run:
+                if n not in futures:
+                    _run_stage(stages[n], path, path[n])
+                    print('done', n)
+            for n, future in futures.items():
+                future.result()
+                print('done', n)
+            for n in ready:
+                status.setdefault(n, 'run')
+                digest[n] = _file_hash(path[n])
+                pending.remove(n)
+
+    _write_reports(stages, path, os.path.join(output, 'reports'))
+    with open(os.path.join(output, 'manifest.json'), 'w') as f:
+        json.dump({n: {'key': keys[n], 'sha256': digest[n], 'status': status[n]}
+                   for n in stages}, f, indent=1)
+    print(sum(s == 'run' for s in status.values()), 'stages run,',
+          sum(s == 'stored' for s in status.values()), 'stored')
+    return({n: status[n] for n in stages})
+
+
+def build_stages(config):
+    '''stages of the pipeline as dicts with the function to run, the
+    names of the input stages, the parameters and whether they can run
+    in parallel'''
+    scenarios = config['scenarios']
+    baseline = config.get('baseline', list(scenarios)[0])
+    stages = {}
+    for s, path in scenarios.items():
+        stages['times/' + s] = {'func': _stage_times,
+                                'inputs': [],
+                                'params': {'path': path, 'sha256': _file_hash(path)},
+                                'parallel': True}
+        stages['co2eq/' + s] = {'func': _stage_co2eq,
+                                'inputs': ['times/' + s],
+                                'params': {'gwp': config.get('gwp'),
+                                           'patterns': config.get('patterns', {}),
+                                           'year': config.get('year')},
+                                'parallel': True}
+        if s != baseline:
+            stages['screen/' + s] = {'func': _stage_screen,
+                                     'inputs': ['co2eq/' + baseline, 'co2eq/' + s],
+                                     'params': {'cutoff': config.get('cutoff', 0.95)},
+                                     'parallel': True}
+            # only the selection is used later, so a change of the
+            # emissions that keeps it does not harmonise again
+            stages['selected/' + s] = {'func': _stage_selected,
+                                       'inputs': ['screen/' + s],
+                                       'params': {},
+                                       'parallel': True}
+
+    harmonise = config.get('harmonise')
+    if harmonise is None:
+        return(stages)
+    for s in scenarios:
+        params = dict(harmonise,
+                      scenario=s,
+                      database=harmonise['database'].format(scenario=s),
+                      mapping_sha256=_file_hash(harmonise['mapping']))
+        stages['harmonise/' + s] = {'func': _stage_harmonise,
+                                    'inputs': ['times/' + s] + (['selected/' + s] if s != baseline else []),
+                                    'params': params,
+                                    'parallel': False}
+        if 'lca' in config and not harmonise.get('dry_run', False):
+            stages['lca/' + s] = {'func': _stage_lca,
+                                  'inputs': ['harmonise/' + s],
+                                  'params': {'methods': config['lca']['methods'],
+                                             'database': params['database'],
+                                             'project': harmonise.get('project'),
+                                             'workers': config['lca'].get('workers')},
+                                  'parallel': False}
+    return(stages)
+
+
+def _stage_key(name, stage, inputs):
+    '''hash of a stage, from its parameters and the hashes of the
+    content of its inputs'''
+    content = json.dumps([STAGE_VERSION, name, stage['params'], inputs],
+                         sort_keys=True, default=str)
+    return(hashlib.sha256(content.encode()).hexdigest()[:16])
+
+
+def _run_stage(stage, path, target):
+    '''runs a stage with the stored results of its inputs and stores
+    its result'''
+    inputs = []
+    for i in stage['inputs']:
+        with open(path[i], 'rb') as f:
+            inputs.append(pickle.load(f))
+    result = stage['func'](stage['params'], *inputs)
+    with open(target + '.tmp', 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(target + '.tmp', target)
+
+
+def _stage_times(params):
+    return(preprocess_times(params['path']))
+
+
+def _stage_co2eq(params, times):
+    bio = tech_and_bio(times, **params['patterns'])[0]
+    co2eq = co2eq_cube(bio, gwp=params['gwp'])
+    if params['year'] is None:
+        return(co2eq.sum(axis=1))
+    return(co2eq[params['year']])
+
+
+def _stage_screen(params, baseline, alternative):
+    return(screen_processes(baseline, alternative, cutoff=params['cutoff']))
+
+
+def _stage_selected(params, screen):
+    return(sorted(set(screen.index), key=str))
+
+
+def _stage_harmonise(params, times, selected=None):
+    if params.get('project') is not None:
+        bw.projects.set_current(params['project'])
+    mapping = pd.read_csv(params['mapping'])
+    mapping['activity'] = list(zip(mapping.pop('database'), mapping.pop('code')))
+    if selected is not None:
+        mapping = mapping[mapping['times_pcode'].isin(selected)]
+
+    kwargs = {k: params[k] for k in ('attribute_in', 'commodities_in') if k in params}
+    efficiency = process_efficiency(times,
+                                    attribute_out=params.get('attribute_out', 'VAR_FOut'),
+                                    commodities_out=params.get('commodities_out'),
+                                    **kwargs)
+    providers = {c: tuple(k) for c, k in params.get('providers', {}).items()}
+    return(harmonise_scenario(mapping,
+                              params['scenario'],
+                              params['database'],
+                              scale_factors=efficiency_factors(efficiency,
+                                                               params.get('reference')),
+                              fuels=main_fuel(times, **kwargs),
+                              providers=providers,
+                              dry_run=params.get('dry_run', False)))
+
+
+def _stage_lca(params, report):
+    if params.get('project') is not None:
+        bw.projects.set_current(params['project'])
+    codes = report.loc[report['status'] == 'ok', 'code']
+    if len(codes) == 0:
+        return(None)
+    mlca = multi_lca([{(params['database'], c): 1} for c in codes],
+                     [tuple(m) for m in params['methods']],
+                     workers=params.get('workers'))
+    return(mlca_todf(mlca))
+
+
+def _write_reports(stages, path, directory):
+    '''writes the results of the screening, harmonisation and LCA
+    stages as csv files'''
+    os.makedirs(directory, exist_ok=True)
+    for name, stage in stages.items():
+        if stage['func'] not in (_stage_screen, _stage_harmonise, _stage_lca):
+            continue
+        with open(path[name], 'rb') as f:
+            result = pickle.load(f)
+        if result is not None:
+            result.to_csv(os.path.join(directory, name.replace('/', '_') + '.csv'))
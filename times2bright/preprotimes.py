@@ -1,7 +1,13 @@
+import glob
+import hashlib
+import json
+import os
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
 
-def preprocess_times(path):
+def preprocess_times(path, cache=False, compact=False):
     '''receives a excel file output of times, with scenario/attribute/
     commodity/process in the first row and year and timeslice in the
     header. it returns a clean dataframe with the same info, but using
@@ -10,24 +16,259 @@ def preprocess_times(path):
     parameters:
     ----------
     path:file path to the excel file
+    cache: bool
+        if true the clean dataframe is stored next to the excel file
+        in a columnar (parquet) format and reused in later calls, as
+        long as the excel file has not changed. Needs pyarrow or
+        fastparquet.
+    compact: bool
+        if true the dataframe is returned using compact_times
 
     returns: pandas dataframe
 
    '''
+    if cache is True:
+        io, scenario = _cached_times(path)
+    else:
+        io, scenario = _read_times(path)
+
+    print(scenario)
+    if compact is True:
+        io = compact_times(io)
+    return(io)
+
+
+def compact_times(df, categories=None, rtol=1e-6):
+    '''reduces the memory used by a dataframe generated with
+    preprocess_times or load_scenarios. The index levels are stored as
+    categoricals (integer codes and a dictionary of labels) and the
+    values as float32 if the precision allows it. It prints the memory
+    saved.
+
+    parameters:
+    ----------
+    df: pandas dataframe
+        generated with preprocess_times or load_scenarios
+    categories: dict
+        labels to use per index level (e.g. {'commodity':[...]}), to share
+        the same dictionary between dataframes compacted separately.
+        Labels of df missing in the dict are added at the end.
+    rtol: float
+        maximum relative error accepted to store values as float32
+
+    returns: pandas dataframe
+        same index, header and values as df
+    '''
+    if categories is None:
+        categories = {}
+
+    before = df.memory_usage(deep=True).sum()
+
+    levels = []
+    for level in df.index.levels:
+        labels = pd.Index(categories.get(level.name, []))
+        labels = labels.append(level.difference(labels)) if len(labels) else level
+        levels.append(pd.CategoricalIndex(level,
+                                          categories=labels,
+                                          name=level.name))
+
+    df = df.copy()
+    df.index = df.index.set_levels(levels)
+
+    values = df.to_numpy(dtype='float64')
+    with np.errstate(over='ignore', under='ignore'):
+        values32 = values.astype('float32')
+    if np.allclose(values32, values, rtol=rtol, atol=0, equal_nan=True):
+        df = df.astype('float32')
+    else:
+        print('careful, precision of float32 not enough, values kept as float64')
+
+    after = df.memory_usage(deep=True).sum()
+    print('memory used: {:.1f} MB, before {:.1f} MB ({:.0%} saved)'.format(
+        after/1e6, before/1e6, 1-after/before))
+    return(df)
+
+
+def load_scenarios(paths, cache=False, workers=None, compact=False):
+    '''parses several excel files exported from times in parallel and
+    returns them in a single dataframe, with the scenario name as the
+    first level of the index. Files that cannot be parsed are reported
+    but do not stop the others.
+
+    parameters:
+    ----------
+    paths: list of file paths or string
+        a string is used as a glob pattern (e.g. 'results/*.xlsx')
+    cache: bool
+        passed to preprocess_times
+    workers: int
+        number of processes, by default all the cores
+    compact: bool
+        if true the dataframe is returned using compact_times, with
+        one dictionary of labels shared by all scenarios
+
+    returns: tuple
+        pandas dataframe with a multiindex [scenario,attribute,commodity,
+        process] and a dict with the files that failed and their error
+    '''
+    if isinstance(paths, str):
+        paths = sorted(glob.glob(paths))
+
+    frames = {}
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path, scenario, io, error in pool.map(_load_scenario,
+                                                  paths,
+                                                  [cache]*len(paths)):
+            if error is not None:
+                print('careful, could not load', path)
+                print(error)
+                failures[path] = error
+            elif scenario in frames:
+                print('careful, scenario', scenario, 'found twice, ignoring', path)
+                failures[path] = 'duplicated scenario ' + str(scenario)
+            else:
+                print(scenario)
+                frames[scenario] = io
+
+    if len(frames) == 0:
+        return(None, failures)
+
+    df = pd.concat(frames, names=['scenario'], sort=False)
+    df.columns = df.columns.rename(['year', 'ts'])
+    if compact is True:
+        df = compact_times(df)
+    return(df, failures)
+
+
+def _load_scenario(path, cache):
+    '''parses one file for load_scenarios, errors are returned
+    instead of raised'''
+    try:
+        if cache is True:
+            io, scenario = _cached_times(path)
+        else:
+            io, scenario = _read_times(path)
+        return(path, scenario, io, None)
+    except Exception as e:
+        return(path, None, None, repr(e))
+
+
+def _read_times(path):
+    '''parses the excel file exported by VEDA-BE. returns the clean
+    dataframe and the name of the scenario'''
     io = pd.read_excel(path,
                      skiprows=6,
                      index_col=0,
                      header=[0, 1]).reset_index(drop=True)
 
-    # print scenario (it should be one)
-    assert(len(io.loc[:, io.columns.get_level_values(1) == "Scenario"].drop_duplicates())==1)
-    print(io.loc[:, io.columns.get_level_values(1) == "Scenario"].drop_duplicates().iloc[0, 0])
+    # scenario (it should be one)
+    is_scenario = io.columns.get_level_values(1) == "Scenario"
+    scenario = io.loc[:, is_scenario].drop_duplicates()
+    assert(len(scenario)==1)
+    scenario = scenario.iloc[0, 0]
     # delete scenario column
-    io = io.loc[:, ~(io.columns.get_level_values(1) == "Scenario")]
+    io = io.loc[:, ~is_scenario]
 
     io = io.set_index([io.columns[0], io.columns[1], io.columns[2]])
     io.index = io.index.rename(['attribute', 'commodity', 'process'])
     io.columns = io.columns.rename(['year', 'ts'])
+    return(io, scenario)
+
+
+def _cache_paths(path):
+    '''files used to cache the excel file, data and key'''
+    return(path + '.t2b.parquet', path + '.t2b.json')
+
+
+def _file_hash(path):
+    '''sha256 of the file content'''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return(h.hexdigest())
+
+
+def _cached_times(path):
+    '''returns the clean dataframe and scenario of an excel file using
+    the cache if it is still valid, otherwise parses the excel file and
+    updates the cache. The cache is keyed on the path, the modification
+    time and the content of the file'''
+    data_path, key_path = _cache_paths(path)
+    stat = os.stat(path)
+
+    try:
+        with open(key_path) as f:
+            key = json.load(f)
+    except (OSError, ValueError):
+        key = None
+
+    if key is not None and key['path'] == os.path.abspath(path):
+        valid = key['mtime'] == stat.st_mtime and key['size'] == stat.st_size
+        if not valid:
+            # touched but maybe not changed
+            sha = _file_hash(path)
+            valid = key['sha256'] == sha
+            if valid:
+                key.update(mtime=stat.st_mtime, size=stat.st_size)
+                _write_key(key_path, key)
+        if valid:
+            try:
+                return(_read_cache(data_path, key), key['scenario'])
+            except Exception as e:
+                print('careful, cache could not be read:', e)
+
+    io, scenario = _read_times(path)
+
+    key = {'path': os.path.abspath(path),
+           'mtime': stat.st_mtime,
+           'size': stat.st_size,
+           'sha256': _file_hash(path),
+           'scenario': scenario}
+    try:
+        _write_cache(data_path, io, key)
+    except Exception as e:
+        print('careful, cache not written:', e)
+        return(io, scenario)
+    _write_key(key_path, key)
+    return(io, scenario)
+
+
+def _as_json(v):
+    '''numpy scalars to python scalars'''
+    return(v.item() if hasattr(v, 'item') else v)
+
+
+def _write_cache(data_path, io, key):
+    '''stores the dataframe in parquet. parquet needs string column
+    names so the (year, ts) header is kept in the key, with all its
+    levels (also the unused ones) to rebuild it as it was'''
+    key['column_levels'] = [[_as_json(v) for v in l] for l in io.columns.levels]
+    key['column_codes'] = [c.tolist() for c in io.columns.codes]
+    key['column_dtypes'] = [str(l.dtype) for l in io.columns.levels]
+    key['scenario'] = _as_json(key['scenario'])
+    flat = io.copy()
+    flat.columns = [str(i) for i in range(flat.shape[1])]
+    flat = flat.reset_index()
+    flat.to_parquet(data_path + '.tmp', index=False)
+    os.replace(data_path + '.tmp', data_path)
+
+
+def _write_key(key_path, key):
+    with open(key_path + '.tmp', 'w') as f:
+        json.dump(key, f)
+    os.replace(key_path + '.tmp', key_path)
+
+
+def _read_cache(data_path, key):
+    '''rebuilds the multiindex dataframe stored with _write_cache'''
+    flat = pd.read_parquet(data_path)
+    io = flat.set_index(['attribute', 'commodity', 'process'])
+    io.columns = pd.MultiIndex(levels=[pd.Index(l, dtype=dtype) for l, dtype in
+                                       zip(key['column_levels'], key['column_dtypes'])],
+                               codes=key['column_codes'],
+                               names=['year', 'ts'])
     return(io)
 
 
@@ -49,11 +290,78 @@ def tech_and_bio(df, pat_ghg_inclusive='CH4|CO2|N2O', pat_ghg_exclusive='CH4|CO2
     dataframes with the biosphere and technosphere flows by process
     the first one contains biosphere flows and the second one technosphere flows
     '''
-    return([df[df.index.get_level_values('commodity').str.contains(pat_ghg_inclusive)],
-            df[~df.index.get_level_values('commodity').str.contains(pat_ghg_exclusive)]
+    classes = classify_commodities(df.index.levels[df.index.names.index('commodity')],
+                                   pat_ghg_inclusive=pat_ghg_inclusive,
+                                   pat_ghg_exclusive=pat_ghg_exclusive)
+    return([df[_commodity_lookup(df.index, classes['biosphere'], False)],
+            df[_commodity_lookup(df.index, classes['technosphere'], False)]
            ])
 
 
+# classes of the commodities already seen, by patterns used
+_commodity_classes = {}
+
+
+def classify_commodities(commodities,
+                         pat_ghg_inclusive='CH4|CO2|N2O',
+                         pat_ghg_exclusive='CH4|CO2|N2O|GHG',
+                         gases=('CO2', 'CH4', 'N2O')):
+    '''classifies commodity labels as biosphere and technosphere flows
+    (same criteria as tech_and_bio) and by the GHG they contain. Each
+    label is matched only once, the classes are kept in memory and
+    reused by later calls with the same patterns.
+
+    parameters:
+    ----------
+    commodities: list-like
+        commodity labels, they can be repeated
+    pat_ghg_inclusive: string
+        used in regex to identify biosphere flows
+    pat_ghg_exclusive: string
+        used in regex to identify what are not technosphere flows
+    gases: tuple of strings
+        gases to look for in the labels
+
+    returns: pandas dataframe
+        indexed by the unique commodity labels, with boolean columns
+        biosphere, technosphere and one per gas
+    '''
+    key = (pat_ghg_inclusive, pat_ghg_exclusive, tuple(gases))
+    labels = pd.Index(np.asarray(commodities, dtype=object)).dropna().unique()
+
+    known = _commodity_classes.get(key)
+    new = labels if known is None else labels.difference(known.index)
+
+    if len(new) > 0 or known is None:
+        s = pd.Series(new, index=new, dtype=object).astype(str).str
+        classes = pd.DataFrame({'biosphere': s.contains(pat_ghg_inclusive),
+                                'technosphere': ~s.contains(pat_ghg_exclusive)},
+                               index=new)
+        for gas in gases:
+            classes[gas] = s.contains(gas, regex=False)
+        known = classes if known is None else pd.concat([known, classes])
+        _commodity_classes[key] = known
+
+    return(known.reindex(labels))
+
+
+def _commodity_lookup(index, per_commodity, fill):
+    '''expands values given per commodity label to the rows of a
+    multiindex, using the integer codes of the commodity level. Rows
+    without commodity get the fill value'''
+    i = index.names.index('commodity')
+    level = np.asarray(index.levels[i], dtype=object)
+    values = np.append(per_commodity.reindex(level).to_numpy(), fill)
+    # the code -1 (missing label) picks the fill value
+    return(values[index.codes[i]])
+
+
+# global warming potentials, rows are gases and columns metrics.
+# GWP100 as implemented for IPCC 2013 by ecoinvent, GWP20 from IPCC 2013
+GWP_TABLE = pd.DataFrame({'GWP100': {'CO2': 1, 'CH4': 29.7, 'N2O': 264.8},
+                          'GWP20': {'CO2': 1, 'CH4': 84, 'N2O': 264}})
+
+
 def calculate_co2eq(emissions_df, ch4gwp=29.7, n2ogwp=264.8):
     '''calculates the total CO2eq emissions per process based on their
     CO2, CH4 and N2O emissions per time slice.
@@ -73,13 +381,178 @@ def calculate_co2eq(emissions_df, ch4gwp=29.7, n2ogwp=264.8):
     returns:
     pandas series with total CO2eq per process, ordered
     '''
-    dfs = emissions_df.sum(axis=1)
-    dfs[dfs.index.get_level_values('commodity').str.contains('CH4')] *= ch4gwp
-    dfs[dfs.index.get_level_values('commodity').str.contains('N2O')] *= n2ogwp
-    dfs=dfs.groupby('process').agg('sum').sort_values(ascending=False)
+    dfs = co2eq_cube(emissions_df,
+                     gwp={'CO2': 1, 'CH4': ch4gwp, 'N2O': n2ogwp}).sum(axis=1)
+    dfs=dfs.groupby('process', observed=True).agg('sum').sort_values(ascending=False)
     return(dfs)
 
 
+def co2eq_cube(emissions_df, gwp=None, metric='GWP100', timeslice=False):
+    '''calculates the CO2eq emissions per process and year (or
+    timeslice) for any set of gases and metrics in one pass. The
+    emissions of a commodity are multiplied by the GWP of the gases
+    found in its label, commodities without any of the gases are
+    assumed to be in CO2eq already.
+
+    parameters:
+    ----------
+    emissions_df: pandas dataframe
+        generated with tech_and_bio, from preprocess_times or
+        load_scenarios (the scenario level is kept)
+    gwp: pandas dataframe or dict
+        gases as rows and metrics as columns, by default GWP_TABLE.
+        A dict {gas: gwp} is used as a single custom metric.
+    metric: string or list of strings
+        column(s) of gwp to use. With a list, the metric is added as
+        first level of the header.
+    timeslice: bool
+        if true the results are given per year and timeslice, otherwise
+        the timeslices are summed.
+
+    returns: pandas dataframe
+        CO2eq with [scenario,] process as index and year [and ts]
+        as header
+    '''
+    if gwp is None:
+        gwp = GWP_TABLE
+    if isinstance(gwp, dict):
+        gwp = pd.DataFrame({'custom': gwp})
+        metric = 'custom'
+    metrics = [metric] if isinstance(metric, str) else list(metric)
+    gwp = gwp.loc[:, metrics]
+
+    index = emissions_df.index
+    classes = classify_commodities(index.levels[index.names.index('commodity')],
+                                   gases=tuple(gwp.index))
+
+    if timeslice is True:
+        values = np.nan_to_num(emissions_df.to_numpy(dtype='float64'))
+        columns = emissions_df.columns
+    else:
+        values, columns = _sum_timeslices(emissions_df)
+
+    by = [n for n in index.names if n not in ('attribute', 'commodity')]
+    cube = {}
+    for m in metrics:
+        # product of the gwp of the gases found in each label
+        per_commodity = pd.Series(np.where(classes[gwp.index].to_numpy(),
+                                           gwp[m].to_numpy(),
+                                           1).prod(axis=1),
+                                  index=classes.index)
+        weights = _commodity_lookup(index, per_commodity, 1).astype('float64')
+        cube[m] = pd.DataFrame(values*weights[:, None],
+                               index=index,
+                               columns=columns).groupby(level=by, observed=True).sum()
+
+    if isinstance(metric, str):
+        return(cube[metric])
+    return(pd.concat(cube, axis=1, names=['metric']))
+
+
+def _sum_timeslices(df):
+    '''sums the timeslices of each year with an indicator matrix.
+    returns the values (missing as 0) and the years'''
+    codes, years = pd.factorize(df.columns.get_level_values('year'))
+    indicator = np.zeros((len(codes), len(years)))
+    indicator[np.arange(len(codes)), codes] = 1
+    values = np.nan_to_num(df.to_numpy(dtype='float64')) @ indicator
+    return(values, pd.Index(years, name='year'))
+
+
+def _flows_by_process(df, attribute, commodities=None):
+    '''yearly flows of one attribute by [scenario,] process and commodity'''
+    df = df.xs(attribute, level='attribute', drop_level=False)
+    if commodities is not None:
+        level = pd.Index(np.asarray(df.index.levels[df.index.names.index('commodity')],
+                                    dtype=object))
+        selected = pd.Series(level.astype(str).str.contains(commodities), index=level)
+        df = df[_commodity_lookup(df.index, selected, False)]
+    values, years = _sum_timeslices(df)
+    by = [n for n in df.index.names if n != 'attribute']
+    return(pd.DataFrame(values, index=df.index, columns=years)
+           .groupby(level=by, observed=True).sum())
+
+
+def process_efficiency(df, attribute_in='VAR_FIn', attribute_out='VAR_FOut',
+                       commodities_in=None, commodities_out=None):
+    '''calculates the efficiency of the processes per year as the sum
+    of their output flows divided by the sum of their input flows
+
+    parameters:
+    ----------
+    df: pandas dataframe
+        generated with preprocess_times or load_scenarios
+    attribute_in: string
+        attribute of the input flows
+    attribute_out: string
+        attribute of the output flows
+    commodities_in: string
+        regex to select the input commodities (e.g. the fuels), by
+        default all
+    commodities_out: string
+        regex to select the output commodities, by default all
+
+    returns: pandas dataframe
+        efficiency with [scenario,] process as index and year as header
+    '''
+    flow_in = _flows_by_process(df, attribute_in, commodities_in)
+    flow_out = _flows_by_process(df, attribute_out, commodities_out)
+    by = [n for n in flow_in.index.names if n != 'commodity']
+    flow_in = flow_in.groupby(level=by, observed=True).sum()
+    flow_out = flow_out.groupby(level=by, observed=True).sum()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        efficiency = flow_out/flow_in
+    return(efficiency.replace([np.inf, -np.inf], np.nan))
+
+
+def efficiency_factors(efficiency, reference=None):
+    '''factors to scale the fuel consumption (e.g. with scale_fuel_cons)
+    of a process according to the change of its efficiency with respect
+    to a reference year. A factor <1 means the process is more
+    efficient than in the reference year.
+
+    parameters:
+    ----------
+    efficiency: pandas dataframe
+        generated with process_efficiency
+    reference: year
+        column of efficiency used as reference, by default the first one
+
+    returns: pandas dataframe
+        same format as efficiency
+    '''
+    if reference is None:
+        reference = efficiency.columns[0]
+    return(efficiency.rdiv(efficiency[reference], axis=0))
+
+
+def main_fuel(df, attribute_in='VAR_FIn', commodities_in=None):
+    '''finds the input commodity with the largest flow per process
+    and year, e.g. to find fuel switches
+
+    parameters:
+    ----------
+    df: pandas dataframe
+        generated with preprocess_times or load_scenarios
+    attribute_in: string
+        attribute of the input flows
+    commodities_in: string
+        regex to select the input commodities, by default all
+
+    returns: pandas dataframe
+        commodity with [scenario,] process as index and year as header,
+        empty if the process has no inputs that year
+    '''
+    flows = _flows_by_process(df, attribute_in, commodities_in)
+    by = [n for n in flows.index.names if n != 'commodity']
+    flows = flows.where(flows > 0)
+    main = {}
+    for year in flows.columns:
+        largest = flows[year].dropna().groupby(level=by, observed=True).idxmax()
+        main[year] = largest.map(lambda i: i[flows.index.names.index('commodity')])
+    return(pd.DataFrame(main).rename_axis(columns='year'))
+
+
 def screen_processes(s_baseline, s_alternative, cutoff=0.95):
     """function to screen the processes that contribute the most to
     the absolute changes in GHGe measured as CO2eq emissions.
@@ -119,17 +592,99 @@ def screen_processes(s_baseline, s_alternative, cutoff=0.95):
         # add one by one until we reach the cut-off criterion
         top_p = (df['absdiffCO2']/df['absdiffCO2']\
         .sum()).sort_values(ascending=False, na_position='last')\
-        .values.tolist()
-        counter=0
-        summation=0
-        for p in top_p:
-            if summation >cutoff:
-                break
-            summation=summation+p
-            counter=counter+1
+        .values
+        counter = int(_n_selected(top_p, cutoff))
 
         df = df.sort_values(by='absdiffCO2', ascending=False)[0:counter]
         df.loc[:, 'contribution'] = df.loc[:, 'absdiffCO2']\
         / df.loc[:, 'absdiffCO2'].sum()*cutoff
 
     return(df)
+
+
+def _n_selected(shares, cutoff):
+    '''number of processes to keep given their contributions sorted in
+    descending order (along the last axis): processes are added one by one
+    until the sum of the contributions goes over the cutoff'''
+    # sum of the contributions before adding each process, added left to
+    # right as the loop of screen_processes did (same rounding)
+    running = np.cumsum(shares, axis=-1)[..., :-1]
+    before = np.concatenate([np.zeros(running.shape[:-1] + (1,)), running], axis=-1)
+    over = before > cutoff
+    return(np.where(over.any(axis=-1), over.argmax(axis=-1), shares.shape[-1]))
+
+
+def screen_batch(co2eq, baseline=None, cutoff=0.95, pairs=False):
+    """screens the processes that contribute the most to the changes
+    in GHGe between a baseline and many alternative scenarios (or between
+    all pairs of scenarios) at once. Same criteria as screen_processes.
+
+    parameters:
+    ----------
+    co2eq: pandas dataframe
+       co2eq emissions with scenarios as rows and processes as columns,
+       e.g. co2eq_cube(...)[2030].unstack('process'). Rows can be any
+       label, e.g. (scenario, year) to screen several periods.
+    baseline: row label
+       scenario compared against all the other rows, by default the
+       first row
+    cutoff: float between 0-1
+       proportion of the changes in co2 emissions to be considered in
+       further analysis. Default 0.95 (95%). With cutoff>=1 all the
+       processes are kept.
+    pairs: bool
+       if true every pair of rows is screened, the first one of the
+       pair as baseline. baseline is ignored.
+
+    returns:
+    pandas.dataframe
+       one row per selected process and comparison, with index
+       [baseline_scenario, alternative_scenario, process] and the columns
+       of screen_processes. Ordered by contribution within each comparison.
+       Missing emissions are taken as 0.
+    """
+    values = co2eq.fillna(0).to_numpy(dtype='float64')
+    n = values.shape[0]
+
+    if pairs is True:
+        i_base, i_alt = np.triu_indices(n, 1)
+    else:
+        b = 0 if baseline is None else co2eq.index.get_loc(baseline)
+        i_alt = np.array([i for i in range(n) if i != b], dtype=int)
+        i_base = np.full(len(i_alt), b)
+
+    diff = values[i_alt] - values[i_base]
+    absdiff = np.abs(diff)
+
+    # processes sorted by absolute difference, per comparison
+    order = np.argsort(-absdiff, axis=1, kind='stable')
+    sorted_abs = np.take_along_axis(absdiff, order, axis=1)
+
+    if cutoff >= 1:
+        counter = np.full(len(order), order.shape[1])
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shares = sorted_abs/sorted_abs.sum(axis=1, keepdims=True)
+        counter = _n_selected(shares, cutoff)
+
+    selected = np.arange(order.shape[1])[None, :] < counter[:, None]
+    comparison, position = np.nonzero(selected)
+    process = order[comparison, position]
+
+    selected_abs = sorted_abs[comparison, position]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        contribution = selected_abs\
+        / (sorted_abs*selected).sum(axis=1)[comparison]*min(cutoff, 1)
+
+    index = pd.MultiIndex.from_arrays(
+        [co2eq.index[i_base[comparison]],
+         co2eq.index[i_alt[comparison]],
+         co2eq.columns[process]],
+        names=['baseline_scenario', 'alternative_scenario', 'process'])
+
+    return(pd.DataFrame({'alternative': values[i_alt[comparison], process],
+                         'baseline': values[i_base[comparison], process],
+                         'diffCO2': diff[comparison, process],
+                         'absdiffCO2': selected_abs,
+                         'contribution': contribution},
+                        index=index))
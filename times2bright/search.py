@@ -0,0 +1,338 @@
+import hashlib
+import numpy as np
+import os
+import pandas as pd
+import pickle
+import re
+from ._lazy import lazy_import
+from .analyse import find_isic
+
+bw = lazy_import('brightway2')
+ActivityDataset = lazy_import('bw2data.backends.peewee', 'ActivityDataset')
+sqlite3_lci_db = lazy_import('bw2data.backends.peewee', 'sqlite3_lci_db')
+safe_filename = lazy_import('bw2data.filesystem', 'safe_filename')
+
+
+# bump when the columns of the index change, older files are rebuilt
+INDEX_VERSION = 2
+
+# indexes already loaded, by (project, database)
+_activity_indexes = {}
+
+
+def activity_index(database, rebuild=False):
+    '''returns a table with the searchable fields of all the activities
+    of a database. The table is stored in the project directory and only
+    the activities added, removed or changed since it was stored are read
+    again when the database changes.
+
+    parameters:
+    ----------
+    database: string
+        name of the brightway2 database
+    rebuild: bool
+        if true all the activities are read again
+
+    returns: pandas dataframe
+        indexed by the activity code, with columns name, reference product,
+        location, unit, activity type, isic and isic description
+    '''
+    modified = bw.databases[database].get('modified')
+    memory_key = (bw.projects.current, database)
+
+    stored = _activity_indexes.get(memory_key)
+    if stored is None:
+        stored = _load_index(database)
+    if rebuild is False and stored is not None and stored['modified'] == modified:
+        _activity_indexes[memory_key] = stored
+        return(stored['table'])
+
+    table, signatures = _build_index(database, None if rebuild else stored)
+    stored = {'version': INDEX_VERSION, 'modified': modified,
+              'table': table, 'signatures': signatures}
+    _activity_indexes[memory_key] = stored
+    _save_index(database, stored)
+    return(table)
+
+
+def _index_path(database):
+    return(os.path.join(bw.projects.request_directory('times2bright'),
+                        'index_' + safe_filename(database) + '.pickle'))
+
+
+def _load_index(database):
+    try:
+        with open(_index_path(database), 'rb') as f:
+            stored = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return(None)
+    if stored.get('version') != INDEX_VERSION:
+        return(None)
+    return(stored)
+
+
+def _save_index(database, stored):
+    path = _index_path(database)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(stored, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def _build_index(database, previous=None):
+    '''reads the activities of the database. The stored data of all the
+    activities is hashed (without unpickling it) and only the activities
+    that are not in previous with the same hash are parsed.
+
+    returns: tuple
+        the table and the hashes by code
+    '''
+    cursor = sqlite3_lci_db.execute_sql(
+        'SELECT code, name, product, location, data FROM "{}" '
+        'WHERE database = ?'.format(ActivityDataset._meta.table_name), (database,))
+    light, signatures, rows = [], {}, {}
+    old = {} if previous is None else previous['signatures']
+    for code, name, product, location, blob in cursor:
+        light.append((code, name, product, location))
+        signatures[code] = hashlib.md5(blob).hexdigest()
+        if old.get(code) == signatures[code]:
+            continue
+        data = pickle.loads(bytes(blob))
+        isic = find_isic(data) or (None, None)
+        rows[code] = (data.get('unit'),
+                      data.get('activity type'),
+                      isic[0],
+                      isic[1])
+
+    light = pd.DataFrame(light, columns=['code', 'name', 'reference product', 'location'])
+    light = light.set_index('code')
+    read = pd.DataFrame.from_dict(rows,
+                                  orient='index',
+                                  columns=['unit',
+                                           'activity type',
+                                           'isic',
+                                           'isic description'])
+    table = light.join(read)
+    if previous is not None:
+        kept = light.index.difference(read.index)
+        table.loc[kept, read.columns] = previous['table'].loc[kept, read.columns]
+
+    table.index.name = 'code'
+    table.attrs['database'] = database
+    return(table, signatures)
+
+
+# ISIC rev.4 sections: letter, last division and description
+ISIC_SECTIONS = [('A', 3, 'Agriculture, forestry and fishing'),
+                 ('B', 9, 'Mining and quarrying'),
+                 ('C', 33, 'Manufacturing'),
+                 ('D', 35, 'Electricity, gas, steam and air conditioning supply'),
+                 ('E', 39, 'Water supply; sewerage, waste management and remediation activities'),
+                 ('F', 43, 'Construction'),
+                 ('G', 47, 'Wholesale and retail trade; repair of motor vehicles and motorcycles'),
+                 ('H', 53, 'Transportation and storage'),
+                 ('I', 56, 'Accommodation and food service activities'),
+                 ('J', 63, 'Information and communication'),
+                 ('K', 66, 'Financial and insurance activities'),
+                 ('L', 68, 'Real estate activities'),
+                 ('M', 75, 'Professional, scientific and technical activities'),
+                 ('N', 82, 'Administrative and support service activities'),
+                 ('O', 84, 'Public administration and defence; compulsory social security'),
+                 ('P', 85, 'Education'),
+                 ('Q', 88, 'Human health and social work activities'),
+                 ('R', 93, 'Arts, entertainment and recreation'),
+                 ('S', 96, 'Other service activities'),
+                 ('T', 98, 'Activities of households as employers'),
+                 ('U', 99, 'Activities of extraterritorial organizations and bodies')]
+
+# isic tables already built, by (project, database)
+_isic_tables = {}
+
+
+def isic_table(database):
+    '''returns the ISIC rev.4 classification of all the activities of
+    a database, built from the activity index and kept in memory until
+    the index changes.
+
+    parameters:
+    ----------
+    database: string
+        name of the brightway2 database
+
+    returns: pandas dataframe
+        indexed by the activity key (database, code), with columns name,
+        location, isic, isic description, division, section and section
+        description. Activities without ISIC code have missing values.
+    '''
+    index = activity_index(database)
+    key = (bw.projects.current, database)
+    stored = _isic_tables.get(key)
+    if stored is not None and stored[0] is index:
+        return(stored[1])
+
+    table = index[['name', 'location', 'isic', 'isic description']].copy()
+    table['division'] = table['isic'].str[:2]
+
+    sections = pd.DataFrame(ISIC_SECTIONS, columns=['section', 'last', 'section description'])
+    division = pd.to_numeric(table['division'], errors='coerce').to_numpy()
+    known = ~np.isnan(division)
+    position = np.searchsorted(sections['last'].to_numpy(), division[known])
+    for column in ('section', 'section description'):
+        values = np.full(len(table), None, dtype=object)
+        values[known] = sections[column].to_numpy()[np.minimum(position, len(sections)-1)]
+        table[column] = values
+
+    table.index = pd.MultiIndex.from_arrays([[database]*len(table), table.index],
+                                            names=['database', 'code'])
+    _isic_tables[key] = (index, table)
+    return(table)
+
+
+def aggregate_by_isic(df, level='division', by=None, values=None):
+    '''adds up results by ISIC code, division or section.
+
+    parameters:
+    ----------
+    df: pandas dataframe
+        results with the activity keys in a 'key' column (as returned by
+        top_contributions) or with 'Database', 'Name' and 'Location'
+        columns (as returned by mlca_todf). In the second case activities
+        with the same name and location share the classification of the
+        first one found.
+    level: string
+        'isic', 'division' or 'section'
+    by: list
+        other columns to group by, e.g. ['scenario'] or ['lca', 'kind']
+    values: list
+        columns to add up, by default all the numeric columns except
+        Amount, lca, rank and share
+
+    returns: pandas dataframe
+        sums with [by and] the level as index. Rows without ISIC code
+        are grouped under 'unclassified'.
+    '''
+    by = [] if by is None else list(by)
+    if values is None:
+        values = [c for c in df.select_dtypes('number').columns
+                  if c not in ['Amount', 'lca', 'rank', 'share'] + by]
+
+    if 'key' in df.columns:
+        keys = df['key'].map(tuple)
+        databases = keys.map(lambda k: k[0]).unique()
+        tables = pd.concat([isic_table(db) for db in databases])
+        labels = tables[level].reindex(pd.MultiIndex.from_tuples(keys)).to_numpy()
+    else:
+        databases = df['Database'].unique()
+        tables = pd.concat([isic_table(db) for db in databases]).reset_index()
+        tables = tables.drop_duplicates(['database', 'name', 'location'])
+        tables = tables.set_index(['database', 'name', 'location'])
+        labels = tables[level].reindex(
+            pd.MultiIndex.from_frame(df[['Database', 'Name', 'Location']])).to_numpy()
+
+    grouped = df[by + values].copy()
+    grouped[level] = pd.Series(labels, index=df.index).fillna('unclassified')
+    return(grouped.groupby(by + [level], sort=True)[values].sum())
+
+
+def search_activities(database,
+                      name=None,
+                      product=None,
+                      location=None,
+                      unit=None,
+                      activity_type=None,
+                      exclude_activity_type=None,
+                      isic=None,
+                      tokens=None,
+                      as_table=False):
+    '''finds the activities of a database that meet all the criteria
+    given, using the activity index. The result can be passed to
+    check_query.
+
+    parameters:
+    ----------
+    database: string
+        name of the brightway2 database
+    name: string or list of strings
+        strings that must be contained in the activity name
+    product: string or list of strings
+        strings that must be contained in the reference product
+    location: string or list of strings
+        accepted locations
+    unit: string or list of strings
+        accepted units
+    activity_type: string or list of strings
+        accepted activity types (e.g. 'ordinary transforming activity')
+    exclude_activity_type: string or list of strings
+        activity types not accepted
+    isic: string
+        start of the isic code, e.g. '35' for the division 35
+    tokens: string or list of strings
+        whole words that must appear in the name (not case sensitive)
+    as_table: bool
+        if true the rows of the activity index are returned instead of
+        the activities
+
+    returns: list of brightway2 activities (or pandas dataframe)
+    '''
+    table = activity_index(database)
+    keep = np.ones(len(table), dtype=bool)
+
+    for column, value in (('name', name), ('reference product', product)):
+        for v in _as_list(value):
+            keep &= table[column].str.contains(v, regex=False, na=False).to_numpy()
+
+    for column, value in (('location', location),
+                          ('unit', unit),
+                          ('activity type', activity_type)):
+        if value is not None:
+            keep &= table[column].isin(_as_list(value)).to_numpy()
+
+    if exclude_activity_type is not None:
+        keep &= ~table['activity type'].isin(_as_list(exclude_activity_type)).to_numpy()
+
+    if isic is not None:
+        keep &= table['isic'].str.startswith(isic, na=False).to_numpy()
+
+    if tokens is not None:
+        keep &= _token_mask(database, table, _as_list(tokens))
+
+    if as_table is True:
+        return(table[keep])
+    return([bw.get_activity((database, code)) for code in table.index[keep]])
+
+
+# name tokens of the loaded indexes, by (project, database)
+_token_indexes = {}
+
+
+def _tokenize(s):
+    return(set(re.findall('[0-9a-z]+', str(s).lower())))
+
+
+def _token_mask(database, table, tokens):
+    '''rows of the table whose name contains all the tokens, using an
+    inverted index {token: row positions} built once per index'''
+    key = (bw.projects.current, database)
+    stored = _token_indexes.get(key)
+    if stored is None or stored[0] is not table:
+        inverted = {}
+        for i, n in enumerate(table['name']):
+            for t in _tokenize(n):
+                inverted.setdefault(t, []).append(i)
+        stored = (table, {t: np.array(v) for t, v in inverted.items()})
+        _token_indexes[key] = stored
+
+    keep = np.ones(len(table), dtype=bool)
+    for token in tokens:
+        for t in _tokenize(token):
+            found = np.zeros(len(table), dtype=bool)
+            found[stored[1].get(t, [])] = True
+            keep &= found
+    return(keep)
+
+
+def _as_list(value):
+    if value is None:
+        return([])
+    if isinstance(value, str):
+        return([value])
+    return(list(value))